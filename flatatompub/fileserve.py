@@ -0,0 +1,226 @@
+"""
+Serving stored files: whole files go through the server's
+``wsgi.file_wrapper`` (which can use sendfile) when there is one, and
+byte ranges (and servers without a file wrapper) are served from an
+mmap of the file.
+"""
+import os
+import mmap
+import random
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from webob import Request
+from webob.exc import HTTPMethodNotAllowed
+
+class MmapIterator(object):
+    """
+    Iterates over a list of pieces, each either a string or a
+    ``(start, end)`` byte range of the file
+    """
+
+    def __init__(self, fp, pieces, block_size=65536):
+        self.fp = fp
+        self.pieces = pieces
+        self.block_size = block_size
+        self.map = None
+
+    def __iter__(self):
+        if os.fstat(self.fp.fileno()).st_size:
+            # (empty files can't be mapped)
+            self.map = mmap.mmap(self.fp.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                yield piece
+                continue
+            start, end = piece
+            while start < end:
+                next = min(start + self.block_size, end)
+                yield self.map[start:next]
+                start = next
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fp.close()
+
+def file_app_iter(environ, fp, size, block_size=65536):
+    """
+    Returns an app_iter for the whole of the open file, ``size``
+    bytes long.  ``fp`` can also be a file-like object.
+    """
+    if not hasattr(fp, 'fileno'):
+        # Not a real file (e.g., an entry from a pack store)
+        return [fp.read()]
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(fp, block_size)
+    return MmapIterator(fp, [(0, size)], block_size)
+
+def parse_range(header, size):
+    """
+    Parses a ``Range`` header into a sorted list of non-overlapping
+    ``(start, end)`` ranges (end is exclusive).  Returns None if the
+    header is malformed (and so should be ignored), or ``[]`` if none
+    of the ranges can be satisfied.
+    """
+    if '=' not in header:
+        return None
+    units, spec = header.split('=', 1)
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' not in part:
+            return None
+        first, last = [p.strip() for p in part.split('-', 1)]
+        try:
+            if not first:
+                # A suffix, like -500 for the last 500 bytes
+                if not last:
+                    return None
+                length = int(last)
+                if not length:
+                    continue
+                start, end = max(size - length, 0), size
+            else:
+                start = int(first)
+                if last:
+                    end = int(last) + 1
+                    if end <= start:
+                        return None
+                else:
+                    end = size
+                if start >= size:
+                    continue
+                end = min(end, size)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+class MediaApp(object):
+    """
+    Serves a file for GET and HEAD, with conditional requests and
+    single or multiple byte ranges (``Range``, ``If-Range``).
+    """
+
+    block_size = 65536
+
+    def __init__(self, filename, content_type, etag, mtime=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.etag = etag
+        # The Last-Modified time, if not the file's own mtime:
+        self.mtime = mtime
+
+    def __call__(self, environ, start_response):
+        req = Request(environ)
+        if req.method not in ['GET', 'HEAD']:
+            return HTTPMethodNotAllowed(
+                headers=dict(Allow='GET,HEAD'))(environ, start_response)
+        fp = open(self.filename, 'rb')
+        try:
+            st = os.fstat(fp.fileno())
+            size, mtime = st.st_size, int(st.st_mtime)
+            if self.mtime is not None:
+                mtime = int(self.mtime)
+            headers = [
+                ('ETag', '"%s"' % self.etag),
+                ('Last-Modified', formatdate(mtime, usegmt=True)),
+                ('Accept-Ranges', 'bytes')]
+            if self.not_modified(environ, mtime):
+                fp.close()
+                start_response('304 Not Modified', headers)
+                return []
+            ranges = None
+            if (environ.get('HTTP_RANGE')
+                and self.if_range_matches(environ.get('HTTP_IF_RANGE'), mtime)):
+                ranges = parse_range(environ['HTTP_RANGE'], size)
+            if ranges == []:
+                fp.close()
+                headers.append(('Content-Range', 'bytes */%s' % size))
+                headers.append(('Content-Length', '0'))
+                start_response('416 Requested Range Not Satisfiable', headers)
+                return []
+            if not ranges:
+                status = '200 OK'
+                headers.append(('Content-Type', self.content_type))
+                headers.append(('Content-Length', str(size)))
+                if req.method == 'HEAD':
+                    fp.close()
+                    app_iter = []
+                else:
+                    app_iter = file_app_iter(environ, fp, size, self.block_size)
+            else:
+                status = '206 Partial Content'
+                if len(ranges) == 1:
+                    start, end = ranges[0]
+                    headers.append(('Content-Type', self.content_type))
+                    headers.append(('Content-Range', 'bytes %s-%s/%s'
+                                    % (start, end-1, size)))
+                    pieces = ranges
+                else:
+                    boundary = '%016x' % random.getrandbits(64)
+                    headers.append(('Content-Type',
+                                    'multipart/byteranges; boundary=%s' % boundary))
+                    pieces = []
+                    for start, end in ranges:
+                        pieces.append(
+                            '\r\n--%s\r\nContent-Type: %s\r\n'
+                            'Content-Range: bytes %s-%s/%s\r\n\r\n'
+                            % (boundary, self.content_type, start, end-1, size))
+                        pieces.append((start, end))
+                    pieces.append('\r\n--%s--\r\n' % boundary)
+                length = 0
+                for piece in pieces:
+                    if isinstance(piece, str):
+                        length += len(piece)
+                    else:
+                        length += piece[1] - piece[0]
+                headers.append(('Content-Length', str(length)))
+                if req.method == 'HEAD':
+                    fp.close()
+                    app_iter = []
+                else:
+                    app_iter = MmapIterator(fp, pieces, self.block_size)
+        except:
+            fp.close()
+            raise
+        start_response(status, headers)
+        return app_iter
+
+    def not_modified(self, environ, mtime):
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            etags = [e.strip() for e in environ['HTTP_IF_NONE_MATCH'].split(',')]
+            return ('*' in etags
+                    or '"%s"' % self.etag in etags
+                    or 'W/"%s"' % self.etag in etags)
+        since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if since:
+            since = parsedate_tz(since)
+            if since is not None and mktime_tz(since) >= mtime:
+                return True
+        return False
+
+    def if_range_matches(self, if_range, mtime):
+        """
+        Ranges are only used when there is no ``If-Range``, or it
+        still matches (using strong comparison).
+        """
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == '"%s"' % self.etag
+        date = parsedate_tz(if_range)
+        return date is not None and mktime_tz(date) == mtime
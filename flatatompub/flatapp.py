@@ -5,8 +5,13 @@ from webob.exc import *
 from flatatompub.dec import wsgiapp, bindery
 from taggerclient import atom
 from taggerclient import gdata
-from paste.fileapp import FileApp
+from flatatompub.fileserve import MediaApp, file_app_iter
 import md5
+import binascii
+import base64
+import urllib
+import itertools
+import calendar
 
 @wsgiapp
 def app(req):
@@ -35,31 +40,42 @@ def app(req):
 
 @wsgiapp
 def serve_entry(req):
+    store = req.store
     try:
-        entry = req.store.get_entry(req.slug)
+        fp, info = store.open_entry(req.slug)
     except KeyError, e:
         return HTTPNotFound(
             comment='No file %s' % e.args[0])
-    store = req.store
-    entry = store.get_entry(req.slug)
+    except ValueError, e:
+        return HTTPNotFound(
+            comment=str(e))
     res = check_conditional_headers(
-        req, entry.etag, entry.last_modified)
+        req, info.etag, info.last_modified)
     if res is not None:
+        fp.close()
         return res
+    res = req.response
+    res.content_type = 'application/atom+xml; type=entry'
+    if req.method in ['GET', 'HEAD']:
+        # The stored bytes are exactly what we serve
+        res.app_iter = file_app_iter(req.environ, fp, info.size)
+        res.content_length = info.size
+        res.etag = info.etag
+        res.last_modified = info.last_modified
+        return res
+    fp.close()
+    if req.method not in ['PUT', 'DELETE']:
+        return HTTPMethodNotAllowed(
+            headers=dict(Allow='GET,HEAD,DELETE,PUT'))
+    entry = store.get_entry(req.slug)
     if req.method == 'DELETE':
         entry.delete()
         return HTTPNoContent()
-    elif req.method == 'PUT':
-        atom_entry = atom.ATOM(req.body)
-        if req.config.clean_html:
-            clean_html(atom_entry)
-        entry.atom_entry = atom_entry
-        entry.save()
-    if req.method not in ['GET', 'HEAD', 'PUT']:
-        return HTTPMethodNotAllowed(
-            headers=dict(Allow='GET,HEAD,DELETE,PUT'))
-    res = req.response
-    res.content_type = 'application/atom+xml; type=entry'
+    atom_entry = atom.ATOM(req.body)
+    if req.config.clean_html:
+        clean_html(atom_entry)
+    entry.atom_entry = atom_entry
+    entry.save()
     res.etag = entry.etag
     res.last_modified = entry.last_modified
     res.body = str(entry)
@@ -78,9 +94,10 @@ def serve_feed(req):
     if req.method not in ['GET', 'HEAD']:
         return HTTPMethodNotAllowed(
             headers=dict(allow='GET,HEAD'))
-    feed = make_feed(req.config)
-    feed.updated = req.store.most_recent()
-    if req.if_modified_since and req.if_modified_since >= feed.updated:
+    version, updated = req.store.collection_state()
+    # (HTTP dates have no fractional seconds)
+    if (req.if_modified_since
+        and req.if_modified_since >= updated.replace(microsecond=0)):
         return HTTPNotModified()
     try:
         start_index = int(req.GET.get('start-index', 1))
@@ -88,11 +105,44 @@ def serve_feed(req):
         if start_index < 0:
             raise ValueError("start-index must not be negative")
         max_results = int(req.GET.get('max-results', req.config.page_limit))
-        if max_results < 0:
-            raise ValueError("max-results must not be negative")
+        # (0 would be an empty page, or no limit, depending on how
+        # the feed is paged)
+        if max_results < 1:
+            raise ValueError("max-results must be positive")
     except ValueError, e:
         return HTTPBadRequest(
             "value is invalid: %s" % e)
+    cache = req.store.response_cache
+    if cache is not None and not req.config.stream_feeds:
+        key = cache.make_key(req)
+        cached = cache.get(version, key)
+        if cached is not None:
+            return feed_response(req, cached[0], cached[1], updated)
+    feed = make_feed(req.config)
+    feed.updated = updated
+    if (req.config.cursor_paging
+        or 'after' in req.GET or 'before' in req.GET):
+        try:
+            slugs = cursor_page(req, feed, max_results)
+        except ValueError, e:
+            return HTTPBadRequest(
+                "cursor is invalid: %s" % e)
+    else:
+        slugs = offset_page(req, feed, start_index, max_results)
+    fragments = entry_fragments(req.store, slugs)
+    if req.config.stream_feeds:
+        return stream_response(req, feed, fragments, version, updated)
+    body = ''.join(iter_feed(feed, fragments))
+    etag = md5.new(body).hexdigest()
+    if cache is not None:
+        cache.set(version, key, body, etag)
+    return feed_response(req, body, etag, updated)
+
+def offset_page(req, feed, start_index, max_results):
+    """
+    Pages with ``start-index``, adding the links to ``feed``.  Returns
+    the slugs.
+    """
     full_length, slugs = req.store.index.most_recent(
         req.store, start_index, max_results)
     if start_index:
@@ -121,48 +171,188 @@ def serve_feed(req):
             last_link.href = req.path_url + '?start-index=%s' % (last_pos+1)
             last_link.rel = 'last'
             feed.append(last_link)
-    for slug in slugs:
-        entry = req.store.get_entry(slug)
-        feed.append(entry.atom_entry)
+    return slugs
+
+def cursor_page(req, feed, max_results):
+    """
+    Pages with opaque ``after`` and ``before`` cursors (keys from
+    ``Index.most_recent_page``), adding the links to ``feed``.  Pages
+    don't shift when entries are added, and deep pages cost no more
+    than the first.  Returns the slugs.
+    """
+    after = decode_cursor(req.GET.get('after'))
+    before = decode_cursor(req.GET.get('before'))
+    length = max_results
+    # One more, to see if there is anything past this page:
+    page = req.store.index.most_recent_page(
+        req.store, length+1, after=after, before=before)
+    more = len(page) > length
+    if before is not None:
+        if more:
+            page = page[1:]
+        has_previous, has_next = more, True
+    else:
+        if more:
+            page = page[:-1]
+        has_previous, has_next = after is not None, more
+    if page and has_previous:
+        prev_link = atom.Element('link')
+        prev_link.href = req.path_url + '?before=%s' % encode_cursor(page[0][0])
+        prev_link.rel = 'previous'
+        feed.append(prev_link)
+    if page and has_next:
+        next_link = atom.Element('link')
+        next_link.href = req.path_url + '?after=%s' % encode_cursor(page[-1][0])
+        next_link.rel = 'next'
+        feed.append(next_link)
+    if has_previous:
+        first_link = atom.Element('link')
+        first_link.rel = 'first'
+        first_link.href = req.path_url
+        feed.append(first_link)
+    return [slug for key, slug in page]
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(str(key)).rstrip('=')
+
+def decode_cursor(cursor):
+    if cursor is None:
+        return None
+    cursor = str(cursor)
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except TypeError, e:
+        raise ValueError(str(e))
+
+def feed_response(req, body, etag, last_modified=None):
+    if etag in req.if_none_match:
+        return HTTPNotModified()
     res = req.response
     res.content_type = 'application/atom+xml'
-    res.body = atom.tostring(feed, pretty_print=True)
-    res.last_modified = feed.updated
-    res.etag = md5.new(res.body).hexdigest()
-    if res.etag in req.if_none_match:
+    res.body = body
+    res.etag = etag
+    if last_modified is not None:
+        res.last_modified = last_modified
+    return res
+
+def stream_response(req, feed, fragments, version, last_modified=None):
+    """
+    Returns a response that writes out ``feed`` with the entry
+    ``fragments`` in it, one at a time, so the whole feed is never in
+    memory.  The ETag comes from the collection version and the URL,
+    instead of from the body.
+    """
+    etag = md5.new('%s %s' % (version, req.url)).hexdigest()
+    if etag in req.if_none_match:
         return HTTPNotModified()
+    res = req.response
+    res.content_type = 'application/atom+xml'
+    res.app_iter = iter_feed(feed, fragments)
+    res.etag = etag
+    if last_modified is not None:
+        res.last_modified = last_modified
     return res
 
+def iter_feed(feed, fragments):
+    """
+    Yields the serialized feed, with the (serialized) entry
+    ``fragments`` put in it
+    """
+    body = atom.tostring(feed, pretty_print=True)
+    # Entries go right before the closing </feed>:
+    pos = body.rindex('</')
+    yield body[:pos]
+    for fragment in fragments:
+        yield fragment
+        yield '\n'
+    yield body[pos:]
+
+def entry_fragments(store, slugs, chunk_size=100):
+    """
+    Yields the entries as feed fragments (see
+    ``Store.entry_fragment``), fetched from the index ``chunk_size``
+    at a time if it keeps them
+    """
+    slugs = iter(slugs)
+    while 1:
+        chunk = list(itertools.islice(slugs, chunk_size))
+        if not chunk:
+            break
+        fragments = store.index.entry_fragments(chunk) or {}
+        for slug in chunk:
+            fragment = fragments.get(slug)
+            if fragment is not None:
+                yield fragment
+                continue
+            try:
+                yield store.entry_fragment(slug)
+            except KeyError:
+                # Deleted since the index was asked
+                pass
+
+def gdata_matches(store, query, slugs, start_index, max_results):
+    """
+    Yields the slugs of the page of entries that match ``query`` (None
+    if the index has already matched everything).
+    """
+    skipped = found = 0
+    for slug in slugs:
+        if query is not None:
+            # Need to do more filtering...
+            try:
+                atom_entry = store.get_entry(slug).atom_entry
+            except KeyError:
+                continue
+            if not query.evaluate(atom_entry):
+                continue
+        if skipped < start_index:
+            skipped += 1
+            continue
+        yield slug
+        found += 1
+        if max_results and found >= max_results:
+            break
+
 @wsgiapp
 def serve_gdata(req):
+    cache = req.store.response_cache
+    version = req.store.collection_state()[0]
+    if cache is not None and not req.config.stream_feeds:
+        key = cache.make_key(req)
+        cached = cache.get(version, key)
+        if cached is not None:
+            return feed_response(req, cached[0], cached[1])
     query = gdata.parse_gdata(req)
-    query, slugs = req.store.index.gdata_query(query, req.store)
-    if query is not None:
-        # Need to do more filtering...
-        entries = []
-        for slug in slugs:
-            entry = req.store.get_entry(slug)
-            matches = query.evaluate(entry.atom_entry)
-            if matches:
-                entries.append(entry.atom_entry)
-    else:
-        entries = [req.store.get_entry(slug).atom_entry for slug in slugs]
     ## FIXME: this should do type checking and other stuff
     start_index = int(req.GET.get('start-index', 1))-1
     max_results = int(req.GET.get('max-results', req.config.page_limit))
-    if start_index:
-        entries = entries[start_index:]
-    if max_results:
-        entries = entries[:max_results]
+    query, total, slugs = req.store.index.gdata_page(
+        query, req.store, start_index, max_results)
+    if query is None:
+        # The index did the paging
+        matches = slugs
+    else:
+        matches = gdata_matches(
+            req.store, query, slugs, start_index, max_results)
+    fragments = entry_fragments(req.store, matches)
     feed = make_feed(req.config)
-    feed.extend(entries)
-    res = req.response
-    res.content_type = 'application/atom+xml'
-    res.body = atom.tostring(feed, pretty_print=True)
-    res.etag = md5.new(res.body).hexdigest()
-    if res.etag in req.if_none_match:
-        return HTTPNotModified()
-    return res
+    if (total is not None and max_results
+        and total > start_index + max_results):
+        params = [(name, value.encode('utf8'))
+                  for name, value in req.GET.items()
+                  if name != 'start-index']
+        params.append(('start-index', start_index + max_results + 1))
+        next_link = atom.Element('link')
+        next_link.href = req.path_url + '?' + urllib.urlencode(params)
+        next_link.rel = 'next'
+        feed.append(next_link)
+    if req.config.stream_feeds:
+        return stream_response(req, feed, fragments, version)
+    body = ''.join(iter_feed(feed, fragments))
+    etag = md5.new(body).hexdigest()
+    if cache is not None:
+        cache.set(version, key, body, etag)
+    return feed_response(req, body, etag)
 
 @wsgiapp
 def post_entry(req):
@@ -211,7 +401,12 @@ def post_media(req):
         req.store, suggest_slug=slug)
     media.create(content_type)
     slug = media.slug
-    media.copy_file(req.body_file, req.content_length)
+    try:
+        media.copy_file(req.body_file, req.content_length,
+                        request_sha256(req))
+    except ValueError, e:
+        media.delete(delete_entry=False)
+        return HTTPBadRequest(str(e))
     atom_entry = atom.Element('entry', nsmap=atom.nsmap)
     atom_entry.updated = datetime.utcnow()
     atom_entry.title = slug or content_type.split('/')[-1]
@@ -237,6 +432,22 @@ def post_media(req):
     ## FIXME: Should I set ETag, Last-Modified?
     return res
 
+def request_sha256(req):
+    """
+    Returns the SHA-256 digest (in hex) that the client gave for the
+    request body in a ``Digest`` header (RFC 3230), or None
+    """
+    for item in req.headers.get('Digest', '').split(','):
+        if '=' not in item:
+            continue
+        algorithm, value = item.split('=', 1)
+        if algorithm.strip().lower() == 'sha-256':
+            try:
+                return value.strip().decode('base64').encode('hex')
+            except binascii.Error:
+                return None
+    return None
+
 @wsgiapp
 def serve_service(req):
     res = req.response
@@ -279,26 +490,35 @@ def check_conditional_headers(req, etag, last_modified):
 def serve_media(req):
     slug = req.path_info_pop()
     media = req.store.get_media(slug)
-    fn = media.filename
-    if not os.path.exists(fn):
+    try:
+        fn = media.filename
+    except ValueError, e:
+        return HTTPNotFound(
+            comment=str(e))
+    try:
+        last_modified = media.last_modified
+    except OSError:
         return HTTPNotFound(
             comment='in %s' % fn)
-    app = FileApp(fn, content_type=media.content_type)
-    app.update()
+    etag = media.etag
     res = check_conditional_headers(
-        req, app.calculate_etag(),
-        datetime.fromtimestamp(app.last_modified, UTC))
+        req, etag, last_modified)
     if res is not None:
         return res
     if req.method == 'DELETE':
         media.delete()
         return HTTPNoContent()
     if req.method == 'PUT':
-        media.copy_file(req.body_file, req.content_length)
+        try:
+            media.copy_file(req.body_file, req.content_length,
+                            request_sha256(req))
+        except ValueError, e:
+            return HTTPBadRequest(str(e))
         media.content_type = req.content_type
         return HTTPNoContent()
     if req.method not in ['GET', 'HEAD']:
         return HTTPMethodNotAllowed(
             headers=dict(Allow='GET,HEAD,DELETE,PUT'))
-    return app
+    return MediaApp(fn, media.content_type, etag,
+                    calendar.timegm(last_modified.utctimetuple()))
     
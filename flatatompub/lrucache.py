@@ -0,0 +1,108 @@
+"""
+A thread-safe least-recently-used cache, bounded both by the number
+of items and by their (estimated) total size.
+"""
+import threading
+
+# Positions in a link of the recency list:
+PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+class LRUCache(object):
+
+    def __init__(self, max_items=1000, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links = {}
+            # Sentinel of a circular list; root[NEXT] is the most
+            # recently used link, root[PREV] the least recently used:
+            self.root = root = [None, None, None, None, 0]
+            root[PREV] = root[NEXT] = root
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._push(link)
+            return link[VALUE]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size=0):
+        if not self.max_items:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would just push everything else out
+            self.remove(key)
+            return
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[SIZE]
+            link = [None, None, key, value, size]
+            self.links[key] = link
+            self._push(link)
+            self.bytes += size
+            while (len(self.links) > self.max_items
+                   or (self.max_bytes is not None
+                       and self.bytes > self.max_bytes)):
+                oldest = self.root[PREV]
+                self._unlink(oldest)
+                del self.links[oldest[KEY]]
+                self.bytes -= oldest[SIZE]
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[SIZE]
+        finally:
+            self.lock.release()
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _push(self, link):
+        root = self.root
+        link[PREV] = root
+        link[NEXT] = root[NEXT]
+        root[NEXT][PREV] = link
+        root[NEXT] = link
+
+    def __len__(self):
+        return len(self.links)
+
+    def stats(self):
+        """
+        Returns a dictionary of counters, for sizing the cache.
+        """
+        total = self.hits + self.misses
+        return dict(
+            items=len(self.links),
+            bytes=self.bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=total and float(self.hits) / total or 0.0)
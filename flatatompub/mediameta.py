@@ -0,0 +1,214 @@
+"""
+Where the store keeps what it knows about each media file: the entry
+that owns it, its content type, size, digest, ETag and mtime.
+
+Metadata objects have three methods: ``get(slug)`` returns a
+dictionary of the fields that are known (empty if nothing is known),
+``set(slug, **fields)`` changes fields (a value of None removes the
+field), and ``delete(slug)`` forgets the media.
+"""
+import os
+import threading
+
+fields = ['entry_slug', 'content_type', 'size', 'digest', 'etag', 'mtime']
+
+class SidecarMediaMetadata(object):
+    """
+    Keeps metadata in small files next to each media file (like
+    ``image.jpg.content-type``).  Size isn't kept.
+    """
+
+    sidecars = {
+        'entry_slug': '.entry-slug',
+        'content_type': '.content-type',
+        'digest': '.digest',
+        'etag': '.etag',
+        'mtime': '.mtime',
+        }
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, slug):
+        return self.read(self.store.get_filename(slug, 'media'))
+
+    def read(self, filename):
+        """
+        Reads the sidecars of the media file ``filename``, wherever
+        it is
+        """
+        result = {}
+        for field, ext in self.sidecars.items():
+            fn = filename + ext
+            try:
+                f = open(fn, 'rb')
+            except IOError:
+                continue
+            try:
+                value = f.read().strip()
+            finally:
+                f.close()
+            if value:
+                result[field] = value
+        return result
+
+    def set(self, slug, **values):
+        from flatatompub.store import ensure_parent, write_file
+        for field, value in values.items():
+            if field not in self.sidecars:
+                continue
+            fn = self.store.get_filename(slug, 'media', self.sidecars[field])
+            if value is None:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+            else:
+                ensure_parent(fn)
+                write_file(fn, str(value))
+
+    def delete(self, slug):
+        self.remove(self.store.get_filename(slug, 'media'))
+
+    def remove(self, filename):
+        for ext in self.sidecars.values():
+            fn = filename + ext
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+class SQLiteMediaMetadata(object):
+    """
+    Keeps metadata in one SQLite table, so a lookup is one query.
+
+    Media that isn't in the table yet is looked up in ``fallback``
+    (usually the sidecar files), so a store can be migrated while it
+    is in use (see ``import_media``).
+    """
+
+    def __init__(self, db_filename, fallback=None):
+        self.db_filename = db_filename
+        self.fallback = fallback
+        self.local = threading.local()
+        # Make the table now, so problems show up at startup:
+        self.conn
+
+    def create_table(self, conn):
+        cur = conn.cursor()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            slug TEXT PRIMARY KEY,
+            entry_slug TEXT,
+            content_type TEXT,
+            size INTEGER,
+            digest TEXT,
+            etag TEXT,
+            mtime REAL
+        )""")
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS media_entry_slug ON media (entry_slug)""")
+        cur.close()
+
+    @property
+    def conn(self):
+        try:
+            return self.local.conn
+        except AttributeError:
+            # Only needed with this kind of metadata:
+            from pysqlite2.dbapi2 import connect
+            conn = connect(
+                self.db_filename, isolation_level=None, timeout=30)
+            # (Each time, in case the file was replaced)
+            self.create_table(conn)
+            self.local.conn = conn
+            return conn
+
+    def get(self, slug):
+        cur = self.conn.cursor()
+        cur.execute("""
+        SELECT %s FROM media WHERE slug = ?""" % ', '.join(fields), (slug,))
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            if self.fallback is not None:
+                return self.fallback.get(slug)
+            return {}
+        return dict([(field, value) for field, value in zip(fields, row)
+                     if value is not None])
+
+    def set(self, slug, **values):
+        for field in values:
+            if field not in fields:
+                raise TypeError("Unknown field: %r" % field)
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("""
+            SELECT slug FROM media WHERE slug = ?""", (slug,))
+            if cur.fetchone() is None:
+                # Bring over anything only the fallback knows
+                if self.fallback is not None:
+                    old_values = self.fallback.get(slug)
+                    old_values.update(values)
+                    values = old_values
+                cur.execute("""
+                INSERT INTO media (slug) VALUES (?)""", (slug,))
+            if values:
+                names = values.keys()
+                cur.execute("""
+                UPDATE media SET %s WHERE slug = ?"""
+                            % ', '.join(['%s = ?' % name for name in names]),
+                            tuple([values[name] for name in names]) + (slug,))
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        cur.close()
+
+    def delete(self, slug):
+        cur = self.conn.cursor()
+        cur.execute("""
+        DELETE FROM media WHERE slug = ?""", (slug,))
+        cur.close()
+        if self.fallback is not None:
+            self.fallback.delete(slug)
+
+    def clear(self):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM media")
+        cur.close()
+
+def import_media(store, verbose=False):
+    """
+    Copies the metadata of all the media in the store from the
+    sidecar files into ``store.media_metadata`` (which should be a
+    `SQLiteMediaMetadata`), then removes the sidecar files.
+
+    Sidecars are read next to each media file, wherever it is (so
+    this works whatever ``shard_depth`` the store was opened with).
+    Media without a content-type sidecar is left alone, rather than
+    getting a row that would hide what the sidecars know.
+
+    Returns ``(imported, skipped)``, lists of slugs.
+    """
+    from flatatompub.store import walk_shards, max_shard_depth
+    sidecars = SidecarMediaMetadata(store)
+    imported = []
+    skipped = []
+    for depth, slug, fn in walk_shards(store.media_dir, max_shard_depth):
+        values = sidecars.read(fn)
+        if 'content_type' not in values:
+            if verbose:
+                print 'Skipping %s (no sidecar files found)' % slug
+            skipped.append(slug)
+            continue
+        st = os.stat(fn)
+        values['size'] = st.st_size
+        if 'mtime' in values:
+            # (Media in a shared blob, see Store.write_media)
+            values['mtime'] = float(values['mtime'])
+        else:
+            values['mtime'] = st.st_mtime
+        if verbose:
+            print 'Importing %s' % slug
+        store.media_metadata.set(slug, **values)
+        sidecars.remove(fn)
+        imported.append(slug)
+    return imported, skipped
@@ -0,0 +1,528 @@
+"""
+An index kept entirely in memory, answering GData queries from
+inverted indexes (set intersections) without touching the disk.
+
+The index is saved to a snapshot file, with the store's stamp of
+every entry (see ``Store.entry_stamp``).  On startup the snapshot is
+loaded and only entries whose stamp changed are parsed again.  When
+the collection is changed by someone else (another process, say) the
+same check is run again.
+"""
+import os
+import re
+import atexit
+import threading
+import cPickle as pickle
+from bisect import bisect_left, bisect_right, insort
+from taggerclient import atom
+from taggerclient import gdata
+from flatatompub import naiveindex
+from flatatompub.sqliteindex import as_string, db_date
+from flatatompub.store import ensure_parent, write_file
+
+token_re = re.compile(r'\w+', re.U)
+
+# Bump this when Record changes; older snapshots are ignored:
+snapshot_format = 2
+
+class Record(object):
+    """
+    What is kept about one entry
+    """
+
+    __slots__ = ['stamp', 'edited', 'updated', 'published',
+                 'full_content', 'author_full', 'categories', 'links']
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw.get(name))
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+def text(value):
+    # lxml "smart strings" can't be pickled
+    if value is None:
+        return None
+    return unicode(value)
+
+def text_matches(content, pattern):
+    # Like SQLiteIndex.like_query: all-lowercase patterns match any
+    # case, others match exactly
+    if pattern.lower() == pattern:
+        return pattern in content.lower()
+    return pattern in content
+
+class SortedColumn(object):
+    """
+    ``(value, slug)`` pairs kept in order, for ranges of values
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, value, slug):
+        if value is not None:
+            insort(self.items, (value, slug))
+
+    def remove(self, value, slug):
+        if value is None:
+            return
+        pos = bisect_left(self.items, (value, slug))
+        if pos < len(self.items) and self.items[pos] == (value, slug):
+            del self.items[pos]
+
+    def range(self, min_value, max_value):
+        """
+        The slugs with values in ``[min_value, max_value]`` (either
+        may be None)
+        """
+        start = 0
+        end = len(self.items)
+        if min_value is not None:
+            start = bisect_left(self.items, (min_value,))
+        if max_value is not None:
+            # Every string <= max_value sorts before this:
+            end = bisect_left(self.items, (max_value + u'\x00',))
+        return set([slug for value, slug in self.items[start:end]])
+
+class WordIndex(object):
+    """
+    The slugs of the entries with each word (token), for text
+    queries.  Besides looking up whole words, the words that start
+    with some text, or contain it, are found by bisecting sorted lists
+    of the words and of their suffixes.
+
+    New words are only merged into the sorted lists now and then
+    (they are looked through one by one until then), and words that
+    are gone are left there until the next merge.
+    """
+
+    # Merge when this many words were added or removed:
+    merge_threshold = 1000
+
+    def __init__(self):
+        self.slugs = {}
+        self.tokens = []
+        # (suffix, token) for every suffix of every token:
+        self.suffixes = []
+        self.new_tokens = []
+        self.removed = 0
+
+    def add(self, token, slug):
+        slugs = self.slugs.get(token)
+        if slugs is None:
+            slugs = self.slugs[token] = set()
+            self.new_tokens.append(token)
+        slugs.add(slug)
+
+    def remove(self, token, slug):
+        slugs = self.slugs.get(token)
+        if slugs is not None:
+            slugs.discard(slug)
+            if not slugs:
+                del self.slugs[token]
+                self.removed += 1
+
+    def merge(self):
+        self.tokens = sorted(self.slugs)
+        self.suffixes = [(token[i:], token) for token in self.tokens
+                         for i in range(len(token))]
+        self.suffixes.sort()
+        self.new_tokens = []
+        self.removed = 0
+
+    def find(self, word, start=False, end=False):
+        """
+        The slugs of entries with a word that is ``word``, or (with
+        ``start``) starts with it, or (with ``end``) ends with it, or
+        (with neither) contains it.
+        """
+        if start and end:
+            return self.slugs.get(word, set())
+        if len(self.new_tokens) + self.removed > self.merge_threshold:
+            self.merge()
+        # Every string that starts with word sorts before this:
+        upper = word + u'\uffff'
+        if start:
+            tokens = self.tokens[bisect_left(self.tokens, word):
+                                 bisect_left(self.tokens, upper)]
+            tokens.extend([token for token in self.new_tokens
+                           if token.startswith(word)])
+        else:
+            suffixes = self.suffixes[bisect_left(self.suffixes, (word,)):
+                                     bisect_left(self.suffixes, (upper,))]
+            tokens = [token for suffix, token in suffixes
+                      if not end or suffix == word]
+            for token in self.new_tokens:
+                if token.endswith(word) or (not end and word in token):
+                    tokens.append(token)
+        slugs = set()
+        for token in tokens:
+            slugs.update(self.slugs.get(token, ()))
+        return slugs
+
+class MemoryIndex(naiveindex.Index):
+
+    def __init__(self, snapshot=None, snapshot_interval=100):
+        self.snapshot = snapshot
+        # Save the snapshot after this many changes:
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.RLock()
+        self.reset()
+        self.load_snapshot()
+        # The store's collection version as of the last sync (see
+        # `sync`), and the changes made through this index since:
+        self.synced_version = None
+        self.own_changes = 0
+        self.unsaved_changes = 0
+        self.store = None
+        atexit.register(self.save_snapshot)
+
+    def reset(self):
+        self.records = {}
+        self.edited = SortedColumn()
+        self.updated = SortedColumn()
+        self.published = SortedColumn()
+        # Inverted indexes, all to sets of slugs:
+        self.by_term = {}
+        self.by_category = {}
+        self.by_rel = {}
+        self.words = WordIndex()
+        self.author_words = WordIndex()
+
+    ## Keeping the index:
+
+    def make_record(self, entry, stamp=None):
+        return Record(
+            stamp=stamp,
+            edited=db_date(entry.edited) or '',
+            updated=db_date(entry.updated),
+            published=db_date(entry.published),
+            full_content=text(as_string(entry)),
+            author_full=text(as_string(entry.author)),
+            categories=tuple([(text(cat.term), text(cat.scheme) or u'')
+                              for cat in entry.categories]),
+            links=tuple([(text(link.rel) or u'alternate', text(link.href))
+                         for link in entry.rel_links(None)]))
+
+    def add_record(self, slug, record):
+        self.records[slug] = record
+        self.edited.add(record.edited, slug)
+        self.updated.add(record.updated, slug)
+        self.published.add(record.published, slug)
+        for term, scheme in record.categories:
+            self.by_term.setdefault(term, set()).add(slug)
+            self.by_category.setdefault((term, scheme), set()).add(slug)
+        for key in record.links:
+            self.by_rel.setdefault(key, set()).add(slug)
+        for token in set(token_re.findall(record.full_content.lower())):
+            self.words.add(token, slug)
+        for token in set(token_re.findall(record.author_full.lower())):
+            self.author_words.add(token, slug)
+
+    def remove_record(self, slug):
+        record = self.records.pop(slug, None)
+        if record is None:
+            return None
+        self.edited.remove(record.edited, slug)
+        self.updated.remove(record.updated, slug)
+        self.published.remove(record.published, slug)
+        for term, scheme in record.categories:
+            discard(self.by_term, term, slug)
+            discard(self.by_category, (term, scheme), slug)
+        for key in record.links:
+            discard(self.by_rel, key, slug)
+        for token in set(token_re.findall(record.full_content.lower())):
+            self.words.remove(token, slug)
+        for token in set(token_re.findall(record.author_full.lower())):
+            self.author_words.remove(token, slug)
+        return record
+
+    def set_entry(self, slug, entry, stamp=None):
+        """
+        Adds or replaces the entry
+        """
+        self.remove_record(slug)
+        self.add_record(slug, self.make_record(entry, stamp))
+
+    def entry_added(self, slug, entry):
+        self.lock.acquire()
+        try:
+            self.set_entry(slug, entry)
+            self.changed()
+        finally:
+            self.lock.release()
+
+    entry_updated = entry_added
+
+    def entry_deleted(self, slug, entry):
+        self.lock.acquire()
+        try:
+            self.remove_record(slug)
+            self.changed()
+        finally:
+            self.lock.release()
+
+    def changed(self):
+        self.own_changes += 1
+        self.unsaved_changes += 1
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.reset()
+            self.changed()
+        finally:
+            self.lock.release()
+
+    def sync(self, store):
+        """
+        Brings the index up to date if the collection was changed
+        other than through this index (and loads it the first time).
+        """
+        if store is None:
+            # Nothing to check against
+            return
+        self.lock.acquire()
+        try:
+            self.store = store
+            version = store.collection_state()[0]
+            if (self.synced_version is None
+                or version != self.synced_version + self.own_changes):
+                self.rescan(store)
+            self.synced_version = version
+            self.own_changes = 0
+            if self.unsaved_changes >= self.snapshot_interval:
+                self.save_snapshot()
+        finally:
+            self.lock.release()
+
+    def rescan(self, store):
+        """
+        Compares every entry's stamp with the one recorded, and
+        indexes the entries that are new or changed
+        """
+        slugs = store.entry_slugs()
+        # (Oldest first, so they get added in order)
+        slugs.reverse()
+        for slug in slugs:
+            try:
+                stamp = store.entry_stamp(slug)
+            except KeyError:
+                continue
+            record = self.records.get(slug)
+            if record is not None and record.stamp == stamp:
+                continue
+            try:
+                entry = atom.ATOM(store.read_entry(slug))
+            except KeyError:
+                continue
+            self.set_entry(slug, entry, stamp)
+            self.unsaved_changes += 1
+        gone = set(self.records).difference(slugs)
+        for slug in gone:
+            self.remove_record(slug)
+        self.unsaved_changes += len(gone)
+
+    ## The snapshot:
+
+    def load_snapshot(self):
+        if self.snapshot is None or not os.path.exists(self.snapshot):
+            return
+        f = open(self.snapshot, 'rb')
+        try:
+            try:
+                format, records = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, ValueError):
+                # Corrupt; the first sync will read everything
+                return
+        finally:
+            f.close()
+        if format != snapshot_format:
+            return
+        for slug, record in records.iteritems():
+            self.add_record(slug, record)
+
+    def save_snapshot(self):
+        self.lock.acquire()
+        try:
+            if self.snapshot is None or not self.unsaved_changes:
+                return
+            if self.store is not None:
+                # Entries changed through the index weren't written yet
+                # when they were indexed:
+                for slug, record in self.records.iteritems():
+                    if record.stamp is None:
+                        try:
+                            record.stamp = self.store.entry_stamp(slug)
+                        except KeyError:
+                            pass
+            ensure_parent(self.snapshot)
+            write_file(self.snapshot, pickle.dumps(
+                (snapshot_format, self.records),
+                pickle.HIGHEST_PROTOCOL))
+            self.unsaved_changes = 0
+        finally:
+            self.lock.release()
+
+    ## Queries:
+
+    def gdata_query(self, gdata, store):
+        self.sync(store)
+        self.lock.acquire()
+        try:
+            return (None, self.query_slugs(gdata))
+        finally:
+            self.lock.release()
+
+    def gdata_page(self, gdata, store, start_index, max_results):
+        gdata, slugs = self.gdata_query(gdata, store)
+        if max_results:
+            page = slugs[start_index:start_index+max_results]
+        else:
+            page = slugs[start_index:]
+        return (None, len(slugs), page)
+
+    def query_slugs(self, query):
+        """
+        The slugs matching the whole query, by edited time and then
+        slug
+        """
+        sets = []
+        for value, column in [(query.updated, self.updated),
+                              (query.published, self.published)]:
+            if value:
+                sets.append(column.range(db_date(value[0]),
+                                         db_date(value[1])))
+        if query.category_query:
+            sets.append(self.category_slugs(query.category_query))
+        if query.rels:
+            for key in query.rels.items():
+                sets.append(self.by_rel.get(key, set()))
+        if sets:
+            sets.sort(key=len)
+            slugs = set(sets[0])
+            for other in sets[1:]:
+                slugs.intersection_update(other)
+        else:
+            slugs = None
+        # Text is matched last, on what is left:
+        if query.q:
+            slugs = self.text_slugs(
+                self.words, 'full_content', query.q, slugs)
+        if query.author:
+            slugs = self.text_slugs(
+                self.author_words, 'author_full', query.author, slugs)
+        if slugs is None:
+            slugs = self.records.keys()
+        records = self.records
+        return sorted(slugs, key=lambda slug: (records[slug].edited, slug))
+
+    def text_slugs(self, words, attr, pattern, slugs):
+        """
+        The entries in ``slugs`` (None for all) where the attribute
+        contains pattern.  Each word of the pattern is in some word of
+        a matching entry (the whole word, if the pattern has something
+        on both sides of it), so that narrows it down before the text
+        itself is checked.
+        """
+        pattern_lower = pattern.lower()
+        for match in token_re.finditer(pattern_lower):
+            found = words.find(match.group(0), start=match.start() > 0,
+                               end=match.end() < len(pattern_lower))
+            if slugs is None:
+                slugs = found
+            else:
+                slugs = slugs.intersection(found)
+        if slugs is None:
+            slugs = self.records.keys()
+        return set([slug for slug in slugs
+                    if text_matches(getattr(self.records[slug], attr),
+                                    pattern)])
+
+    def category_slugs(self, query):
+        if isinstance(query, gdata.NOT):
+            return set(self.records).difference(
+                self.category_slugs(query.expr))
+        elif isinstance(query, gdata.AND):
+            slugs = None
+            for expr in query:
+                if slugs is None:
+                    slugs = set(self.category_slugs(expr))
+                else:
+                    slugs.intersection_update(self.category_slugs(expr))
+            if slugs is None:
+                return set(self.records)
+            return slugs
+        elif isinstance(query, gdata.OR):
+            slugs = set()
+            for expr in query:
+                slugs.update(self.category_slugs(expr))
+            return slugs
+        elif isinstance(query, gdata.Category):
+            if query.scheme is None:
+                return self.by_term.get(query.term, set())
+            return self.by_category.get((query.term, query.scheme), set())
+        else:
+            assert 0, (
+                "Unknown category query type: %r" % query)
+
+    def most_recent(self, store, start_index, length):
+        self.sync(store)
+        self.lock.acquire()
+        try:
+            slugs = [slug for edited, slug in reversed(self.edited.items)]
+        finally:
+            self.lock.release()
+        if length is None:
+            return (len(slugs), slugs[start_index:])
+        return (len(slugs), slugs[start_index:start_index+length])
+
+    def most_recent_page(self, store, length, after=None, before=None):
+        # Keys are "edited slug", like SQLiteIndex
+        self.sync(store)
+        key = after or before
+        if key is not None:
+            try:
+                edited, slug = key.split(' ', 1)
+            except ValueError:
+                raise ValueError("Bad key: %r" % key)
+            key = (edited, slug)
+        self.lock.acquire()
+        try:
+            items = self.edited.items
+            if after is not None:
+                items = items[:bisect_left(items, key)]
+                if length is not None:
+                    items = items[max(len(items)-length, 0):]
+            elif before is not None:
+                items = items[bisect_right(items, key):]
+                if length is not None:
+                    items = items[:length]
+            elif length is not None:
+                items = items[max(len(items)-length, 0):]
+            items = list(items)
+        finally:
+            self.lock.release()
+        items.reverse()
+        return [('%s %s' % (edited, slug), slug) for edited, slug in items]
+
+def discard(index, key, slug):
+    slugs = index.get(key)
+    if slugs is not None:
+        slugs.discard(slug)
+        if not slugs:
+            del index[key]
+
+def make_index(global_conf, snapshot=None, snapshot_interval=100):
+    if snapshot is None:
+        ## FIXME: make sure this can't be served, like db.sqlite:
+        snapshot = os.path.join(global_conf['data_dir'],
+                                'db/memoryindex.pickle')
+    return MemoryIndex(snapshot=snapshot,
+                       snapshot_interval=int(snapshot_interval))
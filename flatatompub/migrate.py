@@ -0,0 +1,76 @@
+"""
+Command-line tool for converting the on-disk layout of a store.
+This is safe to run while the application is serving the store (as
+long as the application is already configured for the new layout).
+"""
+import os
+import sys
+import optparse
+from flatatompub.store import Store, detect_shard_depth
+from flatatompub import naiveindex
+from flatatompub.mediameta import import_media
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DATA_DIR')
+parser.add_option(
+    '--media-dir',
+    dest='media_dir',
+    metavar='DIR',
+    help='The media directory (default DATA_DIR/media)')
+parser.add_option(
+    '--shard-depth',
+    dest='shard_depth',
+    type='int',
+    metavar='DEPTH',
+    help='Move files into this many levels of fan-out subdirectories '
+    '(0 for the flat layout)')
+parser.add_option(
+    '--media-metadata',
+    dest='media_metadata',
+    action='store_true',
+    help='Move media metadata from sidecar files into SQLite')
+parser.add_option(
+    '-v', '--verbose',
+    dest='verbose',
+    action='store_true',
+    help='Print each file as it is moved')
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('You must give exactly one DATA_DIR')
+    if options.shard_depth is None and not options.media_metadata:
+        parser.error('Nothing to do (use --shard-depth or --media-metadata)')
+    if options.media_metadata:
+        media_metadata = 'sqlite'
+    else:
+        media_metadata = 'sidecar'
+    shard_depth = options.shard_depth
+    if shard_depth is None:
+        # Keep the layout the store already has
+        shard_depth = detect_shard_depth(args[0])
+        media_dir = options.media_dir or os.path.join(args[0], 'media')
+        if os.path.isdir(media_dir):
+            shard_depth = max(shard_depth, detect_shard_depth(media_dir))
+    store = Store(args[0], media_dir=options.media_dir,
+                  index=naiveindex.Index(),
+                  shard_depth=shard_depth,
+                  media_metadata=media_metadata)
+    if options.shard_depth is not None:
+        for type in ['entry', 'media']:
+            moved = store.migrate_layout(type, verbose=options.verbose)
+            print 'Moved %s %s files into %s' % (
+                moved, type, store.base_dir(type))
+    if options.media_metadata:
+        imported, skipped = import_media(store, verbose=options.verbose)
+        print 'Imported metadata for %s media files' % len(imported)
+        if skipped:
+            print 'Left %s media files alone (no sidecar files):' % (
+                len(skipped))
+            for slug in skipped:
+                print '  %s' % slug
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 """
 Interface for interfacing, coupled with a very naive/slow index over content
 """
+import threading
+from itertools import islice
+from collections import OrderedDict
 
 class Index(object):
 
@@ -45,7 +48,7 @@ class Index(object):
     # media_updated
     # media_deleted
 
-    def clear(self, store):
+    def clear(self):
         """
         Called before the store is completely cleared.
         """
@@ -66,7 +69,29 @@ class Index(object):
         You should not do paging as part of this (max_results,
         start_index).
         """
-        return (gdata, store.entry_slugs())
+        return (gdata, self.entry_slugs(store))
+
+    def gdata_page(self, gdata, store, start_index, max_results):
+        """
+        Returns ``(gdata, total, slug_list)`` for one page of a GData
+        query.  If the index has handled the whole query, gdata is
+        None, slug_list is just the page (skipping ``start_index``
+        matches, and with at most ``max_results``, 0 meaning
+        unlimited), and total is the number of matches.
+
+        Otherwise gdata is what is left of the query and slug_list has
+        all the candidates, as with `gdata_query`; the caller
+        evaluates them only until the page is filled, and total is
+        None.
+        """
+        gdata, slugs = self.gdata_query(gdata, store)
+        if gdata is not None:
+            return (gdata, None, slugs)
+        if max_results:
+            page = slugs[start_index:start_index+max_results]
+        else:
+            page = slugs[start_index:]
+        return (None, len(slugs), page)
 
     def most_recent(self, store, start_index, length):
         """
@@ -76,13 +101,66 @@ class Index(object):
 
         length may be None, meaning unlimited length
         """
-        slugs = store.entry_slugs()
+        slugs = self.entry_slugs(store)
         if length is None:
             # Unlimited
             return (len(slugs), slugs[start_index:])
         else:
             return (len(slugs), slugs[start_index:start_index+length])
 
+    def most_recent_page(self, store, length, after=None, before=None):
+        """
+        Returns ``[(key, slug), ...]`` for up to ``length`` (None
+        meaning unlimited) of the most recent entries, most recent
+        first, for keyset paging.  With ``after``, these are the
+        entries just after (older than) the entry with that key; with
+        ``before``, the entries just before (newer than) it.  Keys are
+        strings, and a page stays the same when new entries are added.
+
+        Unlike `most_recent` with a large start_index, this should
+        cost the same however deep the page is.  Raise ValueError for
+        a key that isn't valid.
+
+        This index uses slugs as keys, so the key of a deleted entry
+        isn't valid anymore.
+        """
+        slugs = self.entry_slugs(store)
+        if after is not None:
+            slugs = slugs[slugs.index(after)+1:]
+        elif before is not None:
+            slugs = slugs[:slugs.index(before)]
+            if length is not None:
+                slugs = slugs[max(len(slugs)-length, 0):]
+        if length is not None:
+            slugs = slugs[:length]
+        return [(slug, slug) for slug in slugs]
+
+    def entry_fragments(self, slugs):
+        """
+        Returns ``{slug: fragment}`` (see ``Store.entry_fragment``)
+        for the entries in the list ``slugs`` that the index keeps
+        itself, or None if it doesn't keep entries.  The rest are
+        read from the store.
+        """
+        return None
+
+    def entry_slugs(self, store):
+        """
+        The slugs of all the entries, most recently changed first
+        """
+        return store.entry_slugs()
+
+    def collection_state(self, store):
+        """
+        Returns ``(version, last_changed)``, where version is a
+        number that increases with every change to the collection,
+        and last_changed is the UTC datetime of the last change.  This
+        must be cheap to call; it is used for every feed request.
+
+        Return None to let the store keep track of this itself.
+        """
+        return None
+
     def categories(self):
         """
         Return the list of applicable categories in the form
@@ -99,5 +177,115 @@ class Index(object):
         return None
     
     
+class SimpleIndex(Index):
+    """
+    The naive index, but keeping the list of entries between
+    requests instead of listing the store each time.  The list is
+    kept up to date from the events, and is read again from the store
+    only when the collection version shows someone else (another
+    process, say) changed it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The slugs, least recently changed first (so an entry that
+        # changes is just removed and added at the end), or None
+        # before the store is first listed:
+        self.listing = None
+        # The collection version the listing was checked at, and the
+        # changes made through this index since:
+        self.synced_version = None
+        self.own_changes = 0
+
+    def entry_added(self, slug, entry):
+        self.lock.acquire()
+        try:
+            if self.listing is not None:
+                self.listing.pop(slug, None)
+                self.listing[slug] = None
+            self.own_changes += 1
+        finally:
+            self.lock.release()
+
+    entry_updated = entry_added
+
+    def entry_deleted(self, slug, entry):
+        self.lock.acquire()
+        try:
+            if self.listing is not None:
+                self.listing.pop(slug, None)
+            self.own_changes += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.listing = OrderedDict()
+            self.own_changes += 1
+        finally:
+            self.lock.release()
+
+    def sync(self, version, store):
+        """
+        Lists the store again if the collection (now at ``version``)
+        was changed by someone else.  Call with the lock held.
+        """
+        if (self.listing is None
+            or version != self.synced_version + self.own_changes):
+            slugs = store.entry_slugs()
+            slugs.reverse()
+            self.listing = OrderedDict([(slug, None) for slug in slugs])
+        self.synced_version = version
+        self.own_changes = 0
+
+    def entry_slugs(self, store):
+        version = store.collection_state()[0]
+        self.lock.acquire()
+        try:
+            self.sync(version, store)
+            return list(reversed(self.listing))
+        finally:
+            self.lock.release()
+
+    def most_recent(self, store, start_index, length):
+        version = store.collection_state()[0]
+        self.lock.acquire()
+        try:
+            self.sync(version, store)
+            if length is None:
+                end = None
+            else:
+                end = start_index + length
+            return (len(self.listing),
+                    list(islice(reversed(self.listing), start_index, end)))
+        finally:
+            self.lock.release()
+
+    def most_recent_page(self, store, length, after=None, before=None):
+        version = store.collection_state()[0]
+        self.lock.acquire()
+        try:
+            self.sync(version, store)
+            if after is None and before is None:
+                slugs = list(islice(reversed(self.listing), length))
+            else:
+                if after is not None:
+                    # Older entries, walking back from after
+                    key, slugs = after, reversed(self.listing)
+                else:
+                    key, slugs = before, iter(self.listing)
+                if key not in self.listing:
+                    raise ValueError("No entry %r" % key)
+                for slug in slugs:
+                    if slug == key:
+                        break
+                slugs = list(islice(slugs, length))
+                if before is not None:
+                    slugs.reverse()
+        finally:
+            self.lock.release()
+        return [(slug, slug) for slug in slugs]
+
 def make_index(global_conf):
-    return Index()
+    return SimpleIndex()
@@ -0,0 +1,457 @@
+"""
+A store that keeps entries in append-only segment ("pack") files in
+``data_dir/packs``, instead of one file per entry.  Media is still
+kept as files, as in `flatatompub.store.Store`.
+
+Each record in a segment is a header line::
+
+    OP SLUG LENGTH CRC32 ETAG MTIME
+
+followed by LENGTH bytes of payload and a newline.  OP is ``P`` for
+a saved entry (the payload is the serialized entry; an empty payload
+reserves the slug) or ``D`` for a deleted entry.  A record only
+counts once it is complete and its CRC matches, so a crash in the
+middle of a write loses only that write; the torn tail is cut off
+by the next writer.
+
+Every process keeps an in-memory index of where each entry's latest
+record is, built by scanning the segments at startup and kept up to
+date by reading whatever other processes have appended since.
+Writers append under an flock on ``packs/lock``.  Compaction copies
+the live records into new segments, bumps ``packs/generation`` (so
+other processes reload their index) and removes the old segments.
+"""
+import os
+import re
+import md5
+import zlib
+import time
+import fcntl
+import threading
+from cStringIO import StringIO
+from datetime import datetime
+from webob import UTC
+from taggerclient import atom
+from flatatompub.store import Store, FileInfo, ensure_exists, write_file
+from flatatompub.store import store_options, convert_options
+
+segment_re = re.compile(r'^(\d{8})\.pack$')
+
+# Positions in an index value:
+SEGMENT, OFFSET, LENGTH, MTIME, ETAG, SIZE = range(6)
+
+def read_record(f, verify):
+    """
+    Reads the record at the current position of ``f``, returning
+    ``(op, slug, payload_offset, length, etag, mtime)`` and leaving
+    ``f`` at the next record.  Returns None if there is no complete
+    record here.  The payload is only read (to check its CRC) if
+    ``verify`` is true.
+    """
+    header = f.readline()
+    if not header.endswith('\n'):
+        return None
+    parts = header.split()
+    if len(parts) != 6 or parts[0] not in ('P', 'D'):
+        return None
+    op, slug, length, crc, etag, mtime = parts
+    try:
+        length, crc, mtime = int(length), int(crc), float(mtime)
+    except ValueError:
+        return None
+    offset = f.tell()
+    if verify:
+        payload = f.read(length)
+        if (len(payload) != length
+            or zlib.crc32(payload) & 0xffffffff != crc):
+            return None
+    else:
+        f.seek(length, 1)
+    if f.read(1) != '\n':
+        return None
+    return op, slug, offset, length, etag, mtime
+
+def make_record(op, slug, payload, etag, mtime):
+    crc = zlib.crc32(payload) & 0xffffffff
+    header = '%s %s %s %s %s %r\n' % (
+        op, slug, len(payload), crc, etag, mtime)
+    return header, header + payload + '\n'
+
+class PackStore(Store):
+
+    def __init__(self, data_dir, segment_size=64*1024*1024,
+                 fsync=False, compact_threshold=0.5,
+                 compact_interval=None, refresh_interval=1.0, **kw):
+        Store.__init__(self, data_dir, **kw)
+        self.pack_dir = os.path.join(self.data_dir, 'packs')
+        ensure_exists(self.pack_dir)
+        self.lock_filename = os.path.join(self.pack_dir, 'lock')
+        self.generation_filename = os.path.join(self.pack_dir, 'generation')
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.compact_threshold = compact_threshold
+        # Lookups check for other processes' writes at most this often
+        # (in seconds); entries that aren't found are always checked:
+        self.refresh_interval = refresh_interval
+        self.last_refresh = 0
+        self.index_lock = threading.RLock()
+        self._reload()
+        if compact_interval:
+            t = threading.Thread(target=self._compactor,
+                                 args=(compact_interval,))
+            t.setDaemon(True)
+            t.start()
+
+    ############################################################
+    ## Segments and the index
+    ############################################################
+
+    def segment_filename(self, segment):
+        return os.path.join(self.pack_dir, '%08d.pack' % segment)
+
+    def segments(self):
+        segments = []
+        for name in os.listdir(self.pack_dir):
+            match = segment_re.search(name)
+            if match:
+                segments.append(int(match.group(1)))
+        segments.sort()
+        return segments
+
+    def read_generation(self):
+        try:
+            f = open(self.generation_filename, 'rb')
+        except IOError:
+            return 0
+        try:
+            return int(f.read().strip() or 0)
+        finally:
+            f.close()
+
+    def _bump_generation(self):
+        """
+        Tells other processes to reload their index.  Call with the
+        lock held.
+        """
+        # (Not self.generation, which may be behind another process's
+        # compaction)
+        write_file(self.generation_filename,
+                   str(self.read_generation() + 1))
+
+    def _reload(self):
+        self.index_lock.acquire()
+        try:
+            self.generation = self.read_generation()
+            # slug -> (segment, offset, length, mtime, etag, record size)
+            self.entries = {}
+            self.total_bytes = self.garbage_bytes = 0
+            segments = self.segments() or [1]
+            self.position = (segments[0], 0)
+            for segment in segments:
+                self.position = (segment, 0)
+                # Only the last segment can have a torn record
+                self._scan(verify=segment == segments[-1])
+        finally:
+            self.index_lock.release()
+
+    def _scan(self, verify=True):
+        """
+        Reads the records after ``self.position`` into the index
+        """
+        segment, offset = self.position
+        try:
+            f = open(self.segment_filename(segment), 'rb')
+        except IOError:
+            return
+        try:
+            f.seek(offset)
+            while 1:
+                record = read_record(f, verify)
+                if record is None:
+                    break
+                op, slug, payload_offset, length, etag, mtime = record
+                size = f.tell() - offset
+                self._apply(op, slug, (segment, payload_offset, length,
+                                       mtime, etag, size))
+                offset = f.tell()
+        finally:
+            f.close()
+        self.position = (segment, offset)
+
+    def _apply(self, op, slug, value):
+        self.total_bytes += value[SIZE]
+        old = self.entries.pop(slug, None)
+        if old is not None:
+            self.garbage_bytes += old[SIZE]
+        if op == 'P':
+            self.entries[slug] = value
+        else:
+            self.garbage_bytes += value[SIZE]
+
+    def refresh(self):
+        """
+        Picks up records written by other processes
+        """
+        self.index_lock.acquire()
+        try:
+            self.last_refresh = time.time()
+            if self.read_generation() != self.generation:
+                self._reload()
+                return
+            while 1:
+                segment, offset = self.position
+                fn = self.segment_filename(segment)
+                if os.path.exists(fn) and os.path.getsize(fn) > offset:
+                    self._scan()
+                if not os.path.exists(self.segment_filename(segment + 1)):
+                    break
+                self.position = (segment + 1, 0)
+        finally:
+            self.index_lock.release()
+
+    def _lookup(self, slug):
+        refreshed = False
+        if time.time() - self.last_refresh >= self.refresh_interval:
+            self.refresh()
+            refreshed = True
+        value = self.entries.get(slug)
+        if (value is None or not value[LENGTH]) and not refreshed:
+            # Maybe another process just wrote it
+            self.refresh()
+            value = self.entries.get(slug)
+        if value is None or not value[LENGTH]:
+            # (an empty record is only a reservation)
+            raise KeyError(slug)
+        return value
+
+    def _read(self, value):
+        f = open(self.segment_filename(value[SEGMENT]), 'rb')
+        try:
+            f.seek(value[OFFSET])
+            return f.read(value[LENGTH])
+        finally:
+            f.close()
+
+    def _lock(self):
+        fd = os.open(self.lock_filename, os.O_RDWR|os.O_CREAT, 0666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _append(self, op, slug, payload, only_new=False):
+        """
+        Appends a record, returning its index value.  With
+        ``only_new``, nothing is written (and None is returned) if the
+        slug already has a record.
+        """
+        if op == 'P' and payload:
+            etag = md5.new(payload).hexdigest()
+        else:
+            etag = '-'
+        lock = self._lock()
+        self.index_lock.acquire()
+        try:
+            self.refresh()
+            if only_new and slug in self.entries:
+                return None
+            segment, offset = self.position
+            fn = self.segment_filename(segment)
+            if os.path.exists(fn) and os.path.getsize(fn) > offset:
+                # Left over from a write that didn't finish
+                f = open(fn, 'r+b')
+                f.truncate(offset)
+                f.close()
+            if offset >= self.segment_size:
+                segment, offset = segment + 1, 0
+            mtime = time.time()
+            header, record = make_record(op, slug, payload, etag, mtime)
+            f = open(self.segment_filename(segment), 'ab')
+            try:
+                f.write(record)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            value = (segment, offset + len(header), len(payload),
+                     mtime, etag, len(record))
+            self._apply(op, slug, value)
+            self.position = (segment, offset + len(record))
+            return value
+        finally:
+            self.index_lock.release()
+            # This also releases the lock
+            os.close(lock)
+
+    def _read_entry(self, slug):
+        """
+        Returns ``(index_value, payload)`` for a live entry
+        """
+        value = self._lookup(slug)
+        try:
+            return value, self._read(value)
+        except IOError:
+            # Compacted away by another process
+            self._reload()
+            value = self._lookup(slug)
+            return value, self._read(value)
+
+    ############################################################
+    ## Compaction
+    ############################################################
+
+    def garbage_ratio(self):
+        if not self.total_bytes:
+            return 0.0
+        return float(self.garbage_bytes) / self.total_bytes
+
+    def compact(self):
+        """
+        Rewrites the live records into new segments, and removes the
+        old segments.
+        """
+        lock = self._lock()
+        self.index_lock.acquire()
+        try:
+            self.refresh()
+            old_segments = self.segments()
+            segment = self.position[0] + 1
+            out = open(self.segment_filename(segment), 'wb')
+            offset = 0
+            try:
+                items = self.entries.items()
+                # Read in the order the records are stored:
+                items.sort(key=lambda item: (item[1][SEGMENT], item[1][OFFSET]))
+                for slug, value in items:
+                    if offset >= self.segment_size:
+                        out.flush()
+                        os.fsync(out.fileno())
+                        out.close()
+                        segment, offset = segment + 1, 0
+                        out = open(self.segment_filename(segment), 'wb')
+                    header, record = make_record(
+                        'P', slug, self._read(value), value[ETAG],
+                        value[MTIME])
+                    out.write(record)
+                    offset += len(record)
+                out.flush()
+                os.fsync(out.fileno())
+            finally:
+                out.close()
+            self._bump_generation()
+            for old_segment in old_segments:
+                os.unlink(self.segment_filename(old_segment))
+            self._reload()
+        finally:
+            self.index_lock.release()
+            os.close(lock)
+
+    def _compactor(self, interval):
+        while 1:
+            time.sleep(interval)
+            try:
+                self.refresh()
+                if self.garbage_ratio() >= self.compact_threshold:
+                    self.compact()
+            except Exception, e:
+                print 'Error compacting %s: %s' % (self.pack_dir, e)
+
+    ############################################################
+    ## Entries
+    ############################################################
+
+    def reserve_slug(self, slug, type):
+        if type != 'entry':
+            return Store.reserve_slug(self, slug, type)
+        self.assert_good_slug(slug)
+        return self._append('P', slug, '', only_new=True) is not None
+
+    def release_slug(self, slug, type):
+        if type != 'entry':
+            return Store.release_slug(self, slug, type)
+        self.refresh()
+        value = self.entries.get(slug)
+        if value is not None and not value[LENGTH]:
+            self._append('D', slug, '')
+
+    def touch_entry(self, slug):
+        self._append('P', slug, '', only_new=True)
+
+    def entry_stamp(self, slug):
+        value = self._lookup(slug)
+        return (value[MTIME], value[LENGTH])
+
+    def read_entry(self, slug):
+        return self._read_entry(slug)[1]
+
+    def open_entry(self, slug):
+        value, data = self._read_entry(slug)
+        return StringIO(data), FileInfo(None, len(data), value[MTIME],
+                                        value[ETAG])
+
+    def save_entry(self, slug, atom_entry):
+        self.assert_good_slug(slug)
+        self.entry_cache.remove(slug)
+        self._append('P', slug, atom.tostring(atom_entry))
+        self.collection_changed()
+
+    def delete_entry(self, slug):
+        self._lookup(slug)
+        self.entry_cache.remove(slug)
+        self._append('D', slug, '')
+        self.collection_changed()
+
+    def etag(self, slug, type):
+        if type != 'entry':
+            return Store.etag(self, slug, type)
+        return self._lookup(slug)[ETAG]
+
+    def set_etag(self, slug, type, etag):
+        if type != 'entry':
+            return Store.set_etag(self, slug, type, etag)
+        # Entry ETags are part of their records
+
+    def last_modified(self, slug, type):
+        if type != 'entry':
+            return Store.last_modified(self, slug, type)
+        return datetime.fromtimestamp(self._lookup(slug)[MTIME], UTC)
+
+    def migrate_layout(self, type, verbose=False):
+        if type == 'entry':
+            # Entries aren't kept as files
+            return 0
+        return Store.migrate_layout(self, type, verbose)
+
+    def clear(self):
+        lock = self._lock()
+        try:
+            for segment in self.segments():
+                os.unlink(self.segment_filename(segment))
+            self._bump_generation()
+            self._reload()
+        finally:
+            os.close(lock)
+        Store.clear(self)
+
+    def entry_slugs(self):
+        self.refresh()
+        entries = [(-value[MTIME], slug)
+                   for slug, value in self.entries.items()
+                   if value[LENGTH]]
+        entries.sort()
+        return [slug for mtime, slug in entries]
+
+pack_options = dict(
+    store_options,
+    segment_size=int,
+    fsync=bool,
+    compact_threshold=float,
+    compact_interval=float,
+    refresh_interval=float,
+    )
+
+def make_store(global_conf, data_dir, index, **options):
+    """
+    Factory for the pack store
+    """
+    return PackStore(data_dir, index=index,
+                     **convert_options(options, pack_options))
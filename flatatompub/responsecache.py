@@ -0,0 +1,92 @@
+"""
+A cache of rendered feeds (the body and its ETag).
+
+Each response is kept under the collection version it was rendered
+at (see ``Store.collection_state``), so a response is never served
+once the collection has changed, even if another process changed
+it.  `ResponseCache.invalidate` is called whenever an entry is saved
+or deleted, and throws out the old responses.
+
+Responses are kept in memory, and optionally also in files in
+``cache_dir``, which are shared by all the processes serving the
+store.  Files are only kept until the next change, so that tier is
+bounded by the number of distinct feed URLs polled between changes.
+"""
+import os
+import md5
+import urllib
+from flatatompub.lrucache import LRUCache
+from flatatompub.store import ensure_exists, write_file
+
+class ResponseCache(object):
+
+    def __init__(self, max_items=100, max_bytes=16*1024*1024,
+                 cache_dir=None):
+        self.memory = LRUCache(max_items, max_bytes)
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            ensure_exists(cache_dir)
+        self.disk_hits = self.disk_misses = 0
+
+    def make_key(self, req):
+        """
+        The key for a request: its URL, with the query string in a
+        normal order.
+        """
+        items = req.GET.items()
+        items.sort()
+        return '%s?%s' % (req.path_url, urllib.urlencode(items))
+
+    def get(self, version, key):
+        """
+        Returns ``(body, etag)``, or None if nothing is cached.
+        """
+        value = self.memory.get((version, key))
+        if value is not None or self.cache_dir is None:
+            return value
+        try:
+            f = open(self.filename(version, key), 'rb')
+        except IOError:
+            self.disk_misses += 1
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.disk_hits += 1
+        etag, body = data.split('\n', 1)
+        value = (body, etag)
+        self.memory.set((version, key), value, len(body))
+        return value
+
+    def set(self, version, key, body, etag):
+        self.memory.set((version, key), (body, etag), len(body))
+        if self.cache_dir is not None:
+            write_file(self.filename(version, key), etag + '\n' + body)
+
+    def filename(self, version, key):
+        return os.path.join(
+            self.cache_dir, '%s-%s' % (version, md5.new(key).hexdigest()))
+
+    def invalidate(self):
+        self.memory.clear()
+        if self.cache_dir is None:
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                # Still being written
+                continue
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                # Someone else got it first
+                pass
+
+    def stats(self):
+        """
+        Returns a dictionary of counters, for sizing the cache.
+        """
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_misses'] = self.disk_misses
+        return stats
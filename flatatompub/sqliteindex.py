@@ -1,7 +1,10 @@
 import os
 import re
-from pysqlite2.dbapi2 import connect
+import zlib
+from webob import UTC
 from flatatompub import naiveindex
+from flatatompub.sqlitepool import ConnectionPool
+from flatatompub.store import make_fragment
 from taggerclient.atom import tostring
 from taggerclient import gdata
 from lxml.etree import XPath
@@ -17,11 +20,57 @@ def as_string(obj):
     
 _as_string = XPath('string()')
 
+like_special_re = re.compile(r'([%_\\])')
+glob_special_re = re.compile(r'([*?[])')
+
 def db_date(dt):
+    """
+    Dates are stored as strings (in UTC), so they compare in order
+    """
     if dt is None:
         return None
-    else:
-        return dt.strftime('%Y-%m-%dT%H:%M:%S')
+    if isinstance(dt, basestring):
+        return dt
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(UTC)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+fts_term_re = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+word_re = re.compile(r'\w', re.U)
+
+def fts_queries(q):
+    """
+    Turns a GData ``q`` into FTS5 queries ``(include, exclude)``.
+    Words and "quoted phrases" must all match, ``word*`` matches a
+    prefix, and ``-word`` excludes entries.  include is None if there
+    is nothing to match (only exclusions); exclude is None if there
+    is nothing to exclude, otherwise it matches the excluded entries.
+    """
+    positive = []
+    negative = []
+    for match in fts_term_re.finditer(q):
+        negate, phrase, word = match.groups()
+        prefix = ''
+        if phrase is None:
+            if word.endswith('*'):
+                word, prefix = word.rstrip('*'), '*'
+            phrase = word
+        if not word_re.search(phrase):
+            # Nothing FTS5 would index
+            continue
+        term = '"%s"%s' % (phrase.replace('"', '""'), prefix)
+        if negate:
+            negative.append(term)
+        else:
+            positive.append(term)
+    include = exclude = None
+    if positive:
+        include = ' AND '.join(positive)
+        if negative:
+            include = '(%s) NOT (%s)' % (include, ' OR '.join(negative))
+    if negative:
+        exclude = ' OR '.join(negative)
+    return include, exclude
 
 def format_sql(msg, *args):
     if args:
@@ -34,16 +83,59 @@ def format_sql(msg, *args):
     msg = '\n'.join(msg)
     return msg
 
-dbs = {}
+def rebuild_table(name, create_sql, columns):
+    """
+    Statements that rebuild a table with a new definition, keeping
+    its rows (in the same order)
+    """
+    columns = ', '.join(columns)
+    return [
+        create_sql % dict(table=name + '_new'),
+        """
+        INSERT INTO %%(table_prefix)s%(name)s_new (%(columns)s)
+        SELECT %(columns)s FROM %%(table_prefix)s%(name)s ORDER BY rowid
+        """ % dict(name=name, columns=columns),
+        "DROP TABLE %%(table_prefix)s%s" % name,
+        "ALTER TABLE %%(table_prefix)s%s_new RENAME TO %%(table_prefix)s%s"
+        % (name, name),
+        ]
 
-def _close_dbs():
-    ## FIXME: only closes in main thread
-    for localobj in dbs.values():
-        try:
-            localobj.conn.close()
-        except AttributeError:
-            pass
-atexit.register(_close_dbs)
+def normalize_row(row):
+    """
+    Makes a row comparable with a row read back from the database
+    (which gives unicode strings)
+    """
+    result = []
+    for value in row:
+        if isinstance(value, str):
+            value = value.decode('utf8')
+        result.append(value)
+    return tuple(result)
+
+class Rows(object):
+    """
+    The rows of a SELECT, read up front so the connection can go
+    back to the pool; acts enough like a cursor for fetching.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.rows = []
 
 class SQLiteIndex(naiveindex.Index):
 
@@ -79,15 +171,103 @@ class SQLiteIndex(naiveindex.Index):
         title STRING
     )"""),
         ]
-    
-    def __init__(self, db_filename, table_prefix='', debug_sql=False):
+
+    # Changes to the tables above, as ``(version, [statements])``;
+    # databases are brought up to date (see `migrate`) by running the
+    # migrations after the version in their schema_version table:
+    migrations = [
+        # Columns declared STRING got numeric affinity (so a slug or
+        # term like "2008" came back as an integer); timestamps are
+        # ISO 8601 strings in UTC (see db_date):
+        (1, rebuild_table('entries', """
+    CREATE TABLE %%(table_prefix)s%(table)s (
+        slug TEXT PRIMARY KEY,
+        id TEXT NOT NULL,
+        title TEXT,
+        published TEXT,
+        updated TEXT,
+        edited TEXT,
+        content TEXT,
+        full_content TEXT,
+        author_email TEXT,
+        author_name TEXT,
+        author_uri TEXT,
+        author_full TEXT
+    )""", ['slug', 'id', 'title', 'published', 'updated', 'edited',
+           'content', 'full_content', 'author_email', 'author_name',
+           'author_uri', 'author_full'])
+         + rebuild_table('categories', """
+    CREATE TABLE %%(table_prefix)s%(table)s (
+        entry_slug TEXT NOT NULL,
+        term TEXT NOT NULL,
+        scheme TEXT,
+        label TEXT
+    )""", ['entry_slug', 'term', 'scheme', 'label'])
+         + rebuild_table('links', """
+    CREATE TABLE %%(table_prefix)s%(table)s (
+        entry_slug TEXT NOT NULL,
+        href TEXT NOT NULL,
+        rel TEXT NOT NULL,
+        type TEXT,
+        title TEXT
+    )""", ['entry_slug', 'href', 'rel', 'type', 'title'])),
+        # Indexes for the lookups and EXISTS subqueries; the second
+        # ones cover the queries so the tables aren't read at all:
+        (2, [
+    """CREATE INDEX IF NOT EXISTS %(table_prefix)sentries_edited
+       ON %(table_prefix)sentries (edited, slug)""",
+    """CREATE INDEX IF NOT EXISTS %(table_prefix)scategories_entry_slug
+       ON %(table_prefix)scategories (entry_slug)""",
+    """CREATE INDEX IF NOT EXISTS %(table_prefix)scategories_term
+       ON %(table_prefix)scategories (term, scheme, entry_slug)""",
+    """CREATE INDEX IF NOT EXISTS %(table_prefix)slinks_entry_slug
+       ON %(table_prefix)slinks (entry_slug)""",
+    """CREATE INDEX IF NOT EXISTS %(table_prefix)slinks_rel
+       ON %(table_prefix)slinks (rel, href, entry_slug)""",
+    ]),
+        # The feed fragment of the entry, if entry_bodies is on (see
+        # `entry_fragments`):
+        (3, [
+    """ALTER TABLE %(table_prefix)sentries ADD COLUMN body BLOB""",
+    ]),
+        # Dates used to be stored in each entry's own time zone, and
+        # the offset wasn't kept; the entries are queued to have their
+        # dates read again from the store (see `fix_dates`):
+        (4, [
+    """CREATE TABLE IF NOT EXISTS %(table_prefix)sdate_fixes (
+        slug TEXT PRIMARY KEY
+    )""",
+    """INSERT OR IGNORE INTO %(table_prefix)sdate_fixes (slug)
+       SELECT slug FROM %(table_prefix)sentries""",
+    ]),
+        ]
+
+    def __init__(self, db_filename, table_prefix='', debug_sql=False,
+                 fulltext=False, pool=None, entry_bodies=False,
+                 compress_bodies=False):
         self.db_filename = db_filename
         db_dir = os.path.dirname(db_filename)
         if not os.path.exists(db_dir):
             os.makedirs(db_dir)
         self.table_prefix = table_prefix
         self.debug_sql = debug_sql
+        # With fulltext, q= is answered from an FTS5 table (matching
+        # words, instead of substrings), ordered by relevance:
+        self.fulltext = fulltext
+        # With entry_bodies, feeds are put together from the entries
+        # kept here, without reading the store:
+        self.entry_bodies = entry_bodies
+        self.compress_bodies = compress_bodies
+        if pool is None:
+            pool = ConnectionPool(db_filename)
+        self.pool = pool
+        atexit.register(self.pool.close)
+        # The writer connection of a transaction in progress, per
+        # thread:
+        self.local = threading.local()
         self.create_database()
+        self.fix_dates_lock = threading.Lock()
+        self.dates_fixed = False
 
     def table_exists(self, table_name):
         cur = self.execute("""
@@ -96,66 +276,144 @@ class SQLiteIndex(naiveindex.Index):
         """ % dict(table_prefix=self.table_prefix, table_name=table_name, ))
         return bool(cur.fetchall())
 
-    @property
-    def conn(self):
-        try:
-            localobj = dbs[self.db_filename]
-        except KeyError:
-            localobj = dbs[self.db_filename] = threading.local()
-        try:
-            conn = localobj.conn
-        except AttributeError:
-            localobj.conn = conn = connect(self.db_filename, isolation_level=None)
-        return conn
-
     def execute(self, sql, *args):
+        """
+        Runs one statement; inside `transaction` it uses that
+        transaction's connection, otherwise a SELECT gets a reader
+        connection and anything else the writer.  A SELECT returns its
+        `Rows`.
+        """
         if self.debug_sql:
             print format_sql(sql, *args)
-        cur = self.conn.cursor()
-        cur.execute(sql, *args)
-        if sql.upper().strip().startswith('SELECT'):
-            return cur
-        else:
-            cur.close()
+        select = sql.upper().strip().startswith('SELECT')
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return self.run(conn, select, sql, *args)
+        conn = self.pool.acquire(readonly=select)
+        try:
+            return self.run(conn, select, sql, *args)
+        finally:
+            self.pool.release(conn, readonly=select)
+
+    def run(self, conn, select, sql, *args):
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, *args)
+            if select:
+                return Rows(cur.fetchall())
             return None
+        finally:
+            cur.close()
 
     def create_database(self):
         for table_name, sql in self.create_table_statements:
             if not self.table_exists(table_name):
                 self.execute(sql % dict(table_prefix=self.table_prefix))
+        self.migrate()
+        if not self.fulltext:
+            # It wouldn't be kept up to date; it is filled again when
+            # fulltext is turned back on:
+            if self.table_exists('entries_fts'):
+                self.execute("""
+                DROP TABLE IF EXISTS %sentries_fts""" % self.table_prefix)
+        elif not self.table_exists('entries_fts'):
+            self.execute("""
+            CREATE VIRTUAL TABLE %(table_prefix)sentries_fts
+            USING fts5(slug UNINDEXED, full_content)
+            """ % dict(table_prefix=self.table_prefix))
+            # Index what is already there:
+            self.execute("""
+            INSERT INTO %(table_prefix)sentries_fts (slug, full_content)
+            SELECT slug, full_content FROM %(table_prefix)sentries
+            """ % dict(table_prefix=self.table_prefix))
+
+    def schema_version(self):
+        if not self.table_exists('schema_version'):
+            return 0
+        cur = self.execute("""
+        SELECT version FROM %sschema_version""" % self.table_prefix)
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return 0
+        return row[0]
+
+    def migrate(self):
+        """
+        Runs the migrations the database doesn't have yet, each in its
+        own transaction (so several processes can start at once).
+        """
+        for version, statements in self.migrations:
+            if self.schema_version() >= version:
+                continue
+            self.transaction(self.run_migration, version, statements)
+
+    def run_migration(self, version, statements):
+        # Someone else may have just done it:
+        if self.schema_version() >= version:
+            return
+        for sql in statements:
+            self.execute(sql % dict(table_prefix=self.table_prefix))
+        self.execute("""
+        CREATE TABLE IF NOT EXISTS %sschema_version (
+            version INTEGER NOT NULL
+        )""" % self.table_prefix)
+        self.execute("DELETE FROM %sschema_version"
+                     % self.table_prefix)
+        self.execute("INSERT INTO %sschema_version (version) VALUES (?)"
+                     % self.table_prefix, (version,))
+
+    def fix_dates(self, store, chunk_size=500):
+        """
+        Reads the dates of the entries queued by migration 4 again
+        from the store.  This is done on the first query that has a
+        store to read from.
+        """
+        if self.dates_fixed or store is None:
+            return
+        self.fix_dates_lock.acquire()
+        try:
+            while not self.dates_fixed:
+                cur = self.execute("""
+                SELECT slug FROM %sdate_fixes LIMIT ?""" % self.table_prefix,
+                                   (chunk_size,))
+                slugs = [row[0] for row in cur.fetchall()]
+                cur.close()
+                if not slugs:
+                    self.dates_fixed = True
+                    break
+                rows = []
+                for slug in slugs:
+                    try:
+                        entry = store.load_entry(slug)
+                    except KeyError:
+                        # Gone from the store; its dates can't be fixed
+                        continue
+                    rows.append((db_date(entry.published),
+                                 db_date(entry.updated),
+                                 db_date(entry.edited), slug))
+                self.transaction(self.set_dates, slugs, rows)
+        finally:
+            self.fix_dates_lock.release()
+
+    def set_dates(self, slugs, rows):
+        self.executemany("""
+        UPDATE %sentries SET published = ?, updated = ?, edited = ?
+        WHERE slug = ?""" % self.table_prefix, rows)
+        self.executemany("""
+        DELETE FROM %sdate_fixes WHERE slug = ?""" % self.table_prefix,
+                         [(slug,) for slug in slugs])
 
     def rewrite_entry(self, slug, entry):
         return entry
 
-    def entry_added(self, slug, entry):
-        self.execute("""
-        INSERT INTO %sentries (
-          slug,
-          id,
-          title,
-          published,
-          updated,
-          edited,
-          content,
-          full_content,
-          author_email,
-          author_name,
-          author_uri,
-          author_full)
-        VALUES (
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?,
-          ?
-        )""" % self.table_prefix, (
+    entry_columns = [
+        'slug', 'id', 'title', 'published', 'updated', 'edited',
+        'content', 'full_content', 'author_email', 'author_name',
+        'author_uri', 'author_full', 'body']
+
+    def entry_row(self, slug, entry):
+        return (
             slug,
             entry.id,
             entry.title,
@@ -167,89 +425,295 @@ class SQLiteIndex(naiveindex.Index):
             entry.author and entry.author.email,
             entry.author and entry.author.name,
             entry.author and entry.author.uri,
-            as_string(entry.author)))
-        for cat in entry.categories:
-            self.execute("""
-            INSERT INTO %scategories (
-              entry_slug,
-              term,
-              scheme,
-              label)
-            VALUES (
-              ?,
-              ?,
-              ?,
-              ?
-            )""" % self.table_prefix, (
-                slug,
-                cat.term,
-                cat.scheme,
-                cat.label))
-        for link in entry.rel_links(None):
-            self.execute("""
-            INSERT INTO %slinks (
-              entry_slug,
-              href,
-              rel,
-              type,
-              title)
-            VALUES (
-              ?,
-              ?,
-              ?,
-              ?,
-              ?
-            )""" % self.table_prefix, (
-                slug,
-                link.href,
-                link.rel or 'alternate',
-                link.type,
-                link.title))
+            as_string(entry.author),
+            self.entry_body(entry))
+
+    def entry_body(self, entry):
+        """
+        The value of the body column: the entry's fragment (possibly
+        zlib-compressed), or None if bodies aren't kept.
+        """
+        if not self.entry_bodies:
+            return None
+        body = make_fragment(tostring(entry))
+        if self.compress_bodies:
+            # Fragments start with <, so these can be told apart:
+            body = zlib.compress(body)
+        return buffer(body)
+
+    def entry_fragments(self, slugs):
+        if not self.entry_bodies:
+            return None
+        fragments = {}
+        # Keep under SQLite's limit on parameters:
+        for pos in range(0, len(slugs), 500):
+            chunk = slugs[pos:pos+500]
+            cur = self.execute("""
+            SELECT slug, body FROM %sentries
+            WHERE slug IN (%s) AND body IS NOT NULL""" % (
+                self.table_prefix, ', '.join(['?']*len(chunk))), chunk)
+            for slug, body in cur.fetchall():
+                body = str(body)
+                if not body.startswith('<'):
+                    body = zlib.decompress(body)
+                fragments[slug] = body
+        return fragments
+
+    def category_rows(self, slug, entry):
+        return [(slug, cat.term, cat.scheme, cat.label)
+                for cat in entry.categories]
+
+    def link_rows(self, slug, entry):
+        return [(slug, link.href, link.rel or 'alternate', link.type,
+                 link.title)
+                for link in entry.rel_links(None)]
+
+    def transaction(self, func, *args):
+        """
+        Calls ``func(*args)`` in one transaction, so readers never see
+        part of the change, and it is committed (and synced) once.
+        All the statements go through the one writer connection.
+        """
+        if getattr(self.local, 'conn', None) is not None:
+            # Already in one
+            return func(*args)
+        conn = self.local.conn = self.pool.acquire()
+        try:
+            self.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except:
+                self.execute('ROLLBACK')
+                raise
+            self.execute('COMMIT')
+            return result
+        finally:
+            self.local.conn = None
+            self.pool.release(conn)
+
+    def executemany(self, sql, rows):
+        if not rows:
+            return
+        if self.debug_sql:
+            print format_sql(sql)
+            print '    (%s rows)' % len(rows)
+        # Only used inside a transaction:
+        cur = self.local.conn.cursor()
+        cur.executemany(sql, rows)
+        cur.close()
+
+    def entry_added(self, slug, entry):
+        self.transaction(self.insert_entry, slug, entry)
 
     def entry_updated(self, slug, entry):
-        self.entry_deleted(slug, entry)
-        self.entry_added(slug, entry)
+        self.transaction(self.update_entry, slug, entry)
 
     def entry_deleted(self, slug, entry):
+        self.transaction(self.delete_entry, slug)
+
+    def insert_entry(self, slug, entry):
+        row = self.entry_row(slug, entry)
+        self.execute("""
+        INSERT INTO %sentries (%s)
+        VALUES (%s)""" % (self.table_prefix, ', '.join(self.entry_columns),
+                          ', '.join(['?']*len(row))), row)
+        if self.fulltext:
+            self.execute("""
+            INSERT INTO %sentries_fts (slug, full_content)
+            VALUES (?, ?)""" % self.table_prefix, (slug, as_string(entry)))
+        self.insert_rows('categories', self.category_rows(slug, entry))
+        self.insert_rows('links', self.link_rows(slug, entry))
+
+    def insert_rows(self, table, rows):
+        if not rows:
+            return
+        columns = self.row_columns[table]
+        self.executemany("""
+        INSERT INTO %s%s (%s)
+        VALUES (%s)""" % (self.table_prefix, table, ', '.join(columns),
+                          ', '.join(['?']*len(columns))), rows)
+
+    # The columns of category_rows and link_rows:
+    row_columns = {
+        'categories': ['entry_slug', 'term', 'scheme', 'label'],
+        'links': ['entry_slug', 'href', 'rel', 'type', 'title'],
+        }
+
+    def update_entry(self, slug, entry):
+        """
+        Updates only the rows that changed
+        """
+        cur = self.execute("""
+        SELECT %s FROM %sentries WHERE slug = ?"""
+                           % (', '.join(self.entry_columns), self.table_prefix),
+                           (slug,))
+        old_row = cur.fetchone()
+        cur.close()
+        if old_row is None:
+            self.insert_entry(slug, entry)
+            return
+        row = self.entry_row(slug, entry)
+        old_row = normalize_row(old_row)
+        if old_row != normalize_row(row):
+            self.execute("""
+            UPDATE %sentries SET %s
+            WHERE slug = ?""" % (
+                self.table_prefix,
+                ', '.join(['%s = ?' % column
+                           for column in self.entry_columns[1:]])),
+                         row[1:] + (slug,))
+            if self.fulltext and old_row[7] != normalize_row(row)[7]:
+                self.execute("""
+                DELETE FROM %sentries_fts WHERE slug = ?"""
+                             % self.table_prefix, (slug,))
+                self.execute("""
+                INSERT INTO %sentries_fts (slug, full_content)
+                VALUES (?, ?)""" % self.table_prefix, (slug, row[7]))
+        self.update_rows('categories', slug, self.category_rows(slug, entry))
+        self.update_rows('links', slug, self.link_rows(slug, entry))
+
+    def update_rows(self, table, slug, rows):
+        columns = self.row_columns[table]
+        cur = self.execute("""
+        SELECT %s FROM %s%s WHERE entry_slug = ?"""
+                           % (', '.join(columns), self.table_prefix, table),
+                           (slug,))
+        old = dict([(normalize_row(row), row) for row in cur.fetchall()])
+        cur.close()
+        new = dict([(normalize_row(row), row) for row in rows])
+        # (IS also matches NULLs)
+        self.executemany("""
+        DELETE FROM %s%s WHERE %s""" % (
+            self.table_prefix, table,
+            ' AND '.join(['%s IS ?' % column for column in columns])),
+                         [row for key, row in old.items() if key not in new])
+        self.insert_rows(table, [row for key, row in new.items()
+                                 if key not in old])
+
+    def delete_entry(self, slug):
         self.execute("""
         DELETE FROM %sentries WHERE slug = ?""" % self.table_prefix, (slug,))
         self.execute("""
         DELETE FROM %scategories WHERE entry_slug = ?""" % self.table_prefix, (slug,))
         self.execute("""
         DELETE FROM %slinks WHERE entry_slug = ?""" % self.table_prefix, (slug,))
+        if self.fulltext:
+            self.execute("""
+            DELETE FROM %sentries_fts WHERE slug = ?""" % self.table_prefix, (slug,))
 
     def clear(self):
-        for table in ['entries', 'categories', 'links']:
+        tables = ['entries', 'categories', 'links']
+        if self.fulltext:
+            tables.append('entries_fts')
+        self.transaction(self.delete_tables, tables)
+
+    def delete_tables(self, tables):
+        for table in tables:
             self.execute("DELETE FROM %s%s" % (self.table_prefix, table))
 
     def gdata_query(self, gdata, store):
+        self.fix_dates(store)
+        from_sql, order_sql, arguments = self.gdata_from(gdata)
+        where_sql, where_args = self.gdata_where(gdata)
+        sql = """
+        SELECT %(table_prefix)sentries.slug
+        FROM %(from_sql)s
+        WHERE %(query)s
+        ORDER BY %(order_sql)s
+        """ % dict(table_prefix=self.table_prefix, from_sql=from_sql,
+                   query=where_sql, order_sql=order_sql)
+        cur = self.execute(sql, tuple(arguments + where_args))
+        slugs = [row[0] for row in cur.fetchall()]
+        cur.close()
+        # Nothing is left to evaluate:
+        return (None, slugs)
+
+    def gdata_page(self, gdata, store, start_index, max_results):
+        self.fix_dates(store)
+        from_sql, order_sql, arguments = self.gdata_from(gdata)
+        where_sql, where_args = self.gdata_where(gdata)
+        arguments = tuple(arguments + where_args)
+        cur = self.execute("""
+        SELECT COUNT(*)
+        FROM %(from_sql)s
+        WHERE %(query)s
+        """ % dict(from_sql=from_sql, query=where_sql), arguments)
+        total = cur.fetchone()[0]
+        cur.close()
+        sql = """
+        SELECT %(table_prefix)sentries.slug
+        FROM %(from_sql)s
+        WHERE %(query)s
+        ORDER BY %(order_sql)s
+        LIMIT ? OFFSET ?
+        """ % dict(table_prefix=self.table_prefix, from_sql=from_sql,
+                   query=where_sql, order_sql=order_sql)
+        cur = self.execute(sql, arguments + (max_results or -1, start_index))
+        slugs = [row[0] for row in cur.fetchall()]
+        cur.close()
+        return (None, total, slugs)
+
+    def gdata_from(self, gdata):
+        """
+        Returns ``(from_sql, order_sql, args)``: the tables to select
+        entries from, and how to order them.  Entries are ordered by
+        edited time (then slug); full-text matches are joined in here,
+        ordered by relevance first.
+        """
+        order_sql = ('%(table_prefix)sentries.edited, '
+                     '%(table_prefix)sentries.slug'
+                     % dict(table_prefix=self.table_prefix))
+        if self.fulltext and gdata.q:
+            include, exclude = fts_queries(gdata.q)
+            if include:
+                from_sql = """
+                %(table_prefix)sentries
+                JOIN (SELECT slug, rank FROM %(table_prefix)sentries_fts
+                      WHERE %(table_prefix)sentries_fts MATCH ?) AS fts_hits
+                ON fts_hits.slug = %(table_prefix)sentries.slug
+                """ % dict(table_prefix=self.table_prefix)
+                return from_sql, 'fts_hits.rank, ' + order_sql, [include]
+        return '%sentries' % self.table_prefix, order_sql, []
+
+    def gdata_where(self, gdata):
+        """
+        Compiles the whole query to ``(sql, args)``, a WHERE clause
+        for the tables from `gdata_from`, so that nothing is left to
+        evaluate.  The query itself isn't changed.
+        """
         items = []
         arguments = []
-        if gdata.q:
+        if gdata.q and self.fulltext:
+            include, exclude = fts_queries(gdata.q)
+            if not include and exclude:
+                # (FTS5 can only exclude from something it matched)
+                items.append("""
+                %(table_prefix)sentries.slug NOT IN (
+                  SELECT slug FROM %(table_prefix)sentries_fts
+                  WHERE %(table_prefix)sentries_fts MATCH ?)
+                """ % dict(table_prefix=self.table_prefix))
+                arguments.append(exclude)
+        elif gdata.q:
             sql, arg = self.like_query('full_content', gdata.q)
             items.append(sql)
             arguments.append(arg)
-            gdata.q = None
         if gdata.author:
             sql, arg = self.like_query('author_full', gdata.author)
             items.append(sql)
             arguments.append(arg)
-            gdata.author = None
         for query, column in [(gdata.updated, 'updated'),
                               (gdata.published, 'published')]:
             if query:
                 if query[0]:
-                    items.append('date(%s) >= date(?)' % db_date(column))
-                    arguments.append(query[0])
+                    items.append('%s >= ?' % column)
+                    arguments.append(db_date(query[0]))
                 if query[1]:
-                    items.append('date(%s) <= date(?)' % db_date(column))
-                    arguments.append(query[1])
-        gdata.updated = gdata.published = None
+                    items.append('%s <= ?' % column)
+                    arguments.append(db_date(query[1]))
         if gdata.category_query:
             item, args = self.category_query(gdata.category_query)
             items.append(item)
             arguments.extend(args)
-            gdata.cateogry_query = None
         if gdata.rels:
             for rel_name, href in gdata.rels.items():
                 items.append("""
@@ -259,27 +723,20 @@ class SQLiteIndex(naiveindex.Index):
                                AND %(table_prefix)slinks.href = ?))
                 """ % dict(table_prefix=self.table_prefix))
                 arguments.extend([rel_name, href])
-            gdata.rels = {}
         if len(items) > 1:
             items = ['(%s)' % i for i in items]
         if not items:
             items = ['1=1']
-        sql = """
-        SELECT %(table_prefix)sentries.slug
-        FROM %(table_prefix)sentries
-        WHERE %(query)s
-        """ % dict(table_prefix=self.table_prefix,
-                   query=' AND '.join(items))
-        cur = self.execute(sql, tuple(arguments))
-        slugs = [row[0] for row in cur.fetchall()]
-        cur.close()
-        return (gdata, slugs)
+        return ' AND '.join(items), arguments
 
     def like_query(self, column, pattern):
+        # All-lowercase patterns match any case (LIKE), others match
+        # exactly (GLOB)
         if pattern.lower() == pattern:
-            return ('%s LIKE ?' % column), '%' + pattern.replace('%', '%%') + '%'
+            pattern = like_special_re.sub(r'\\\1', pattern)
+            return ("%s LIKE ? ESCAPE '\\'" % column), '%' + pattern + '%'
         else:
-            ## FIXME: escape *
+            pattern = glob_special_re.sub(r'[\1]', pattern)
             return ('%s GLOB ?' % column), '*' + pattern + '*'
 
     def category_query(self, query):
@@ -297,6 +754,11 @@ class SQLiteIndex(naiveindex.Index):
                 item, args = self.category_query(expr)
                 items.append(item)
                 all_args.extend(args)
+            if not items:
+                if isinstance(query, gdata.AND):
+                    return '1=1', []
+                else:
+                    return '1=0', []
             if len(items) > 1:
                 items = ['(%s)' % i for i in items]
             return op.join(items), all_args
@@ -330,6 +792,7 @@ class SQLiteIndex(naiveindex.Index):
                 "Unknown category query type: %r" % query)
 
     def most_recent(self, store, start_index, length):
+        self.fix_dates(store)
         if length is None:
             length_sql = ""
             args = (start_index,)
@@ -351,13 +814,78 @@ class SQLiteIndex(naiveindex.Index):
         slugs = [row[0] for row in cur.fetchall()]
         cur.close()
         return (None, slugs)
-            
-def make_index(global_conf, db=None, debug=False, table_prefix=''):
+
+    def most_recent_page(self, store, length, after=None, before=None):
+        # Keys are "edited slug"; entries are ordered by both, so
+        # entries edited in the same second have a fixed order
+        self.fix_dates(store)
+        args = []
+        if after is not None or before is not None:
+            try:
+                edited, slug = (after or before).split(' ', 1)
+            except ValueError:
+                raise ValueError("Bad key: %r" % (after or before))
+            args = [edited, edited, slug]
+        if after is not None:
+            where_sql = "WHERE edited < ? OR (edited = ? AND slug < ?)"
+        elif before is not None:
+            where_sql = "WHERE edited > ? OR (edited = ? AND slug > ?)"
+        else:
+            where_sql = ""
+        if before is not None:
+            # Read forward from the key, and put them back in order
+            order_sql = "ORDER BY edited, slug"
+        else:
+            order_sql = "ORDER BY edited DESC, slug DESC"
+        if length is None:
+            length = -1
+        args.append(length)
+        sql = """
+        SELECT slug, edited
+        FROM %(table_prefix)sentries
+        %(where_sql)s
+        %(order_sql)s
+        LIMIT ?
+        """ % dict(table_prefix=self.table_prefix,
+                   where_sql=where_sql, order_sql=order_sql)
+        cur = self.execute(sql, tuple(args))
+        rows = cur.fetchall()
+        cur.close()
+        if before is not None:
+            rows.reverse()
+        return [('%s %s' % (edited, slug), slug) for slug, edited in rows]
+
+def make_index(global_conf, db=None, debug=False, table_prefix='',
+               fulltext=False, journal_mode='wal', busy_timeout=30,
+               pool_size=5, idle_timeout=300, cache_size=None,
+               mmap_size=None, synchronous=None, entry_bodies=False,
+               compress_bodies=False):
     from paste.deploy.converters import asbool
     if db is None:
         db = global_conf.get('db')
         if db is None:
             ## FIXME: make sure db.sqlite can't be served:
             db = os.path.join(global_conf['data_dir'], 'db/db.sqlite')
+    pragmas = {}
+    if cache_size is not None:
+        pragmas['cache_size'] = int(cache_size)
+    if mmap_size is not None:
+        pragmas['mmap_size'] = int(mmap_size)
+    if synchronous is not None:
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(
+                "Bad value for synchronous: %r" % synchronous)
+        pragmas['synchronous'] = synchronous.upper()
+    if journal_mode.lower() in ('', 'none', 'default'):
+        journal_mode = None
+    pool = ConnectionPool(db, max_readers=int(pool_size),
+                          journal_mode=journal_mode,
+                          busy_timeout=float(busy_timeout),
+                          idle_timeout=float(idle_timeout),
+                          pragmas=pragmas)
     return SQLiteIndex(db, table_prefix=table_prefix,
-                       debug_sql=asbool(debug))
+                       debug_sql=asbool(debug),
+                       fulltext=asbool(fulltext),
+                       pool=pool,
+                       entry_bodies=asbool(entry_bodies),
+                       compress_bodies=asbool(compress_bodies))
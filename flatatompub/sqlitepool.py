@@ -0,0 +1,141 @@
+"""
+A pool of SQLite connections for one database file, shared by the
+threads of a process.
+
+There is one writer connection (SQLite only lets one connection
+write at a time anyway, so threads wait for it here instead of
+getting "database is locked") and up to ``max_readers`` read-only
+connections.  Connections go back to the pool after each use, so
+nothing is tied to a thread; connections left idle for
+``idle_timeout`` seconds are closed.
+
+In WAL mode readers don't block the writer, or the other way around,
+across processes too.  ``busy_timeout`` is how long to wait for
+another process's lock before giving up.
+"""
+import time
+import threading
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool(object):
+
+    def __init__(self, db_filename, max_readers=5, journal_mode='wal',
+                 busy_timeout=30, idle_timeout=300, wait_timeout=60,
+                 pragmas=None):
+        self.db_filename = db_filename
+        self.max_readers = max_readers
+        self.journal_mode = journal_mode
+        self.busy_timeout = busy_timeout
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        # Like cache_size, mmap_size, synchronous; set on every
+        # connection:
+        self.pragmas = pragmas or {}
+        self.lock = threading.Condition()
+        # Idle connections, as (conn, time released), most recently
+        # used last:
+        self.idle = {True: [], False: []}
+        # Connections in use or idle:
+        self.open_count = {True: 0, False: 0}
+
+    def limit(self, readonly):
+        if readonly:
+            return self.max_readers
+        return 1
+
+    def acquire(self, readonly=False):
+        """
+        Returns a connection, which you must give back with
+        `release`.  Waits (up to ``wait_timeout``) if all the
+        connections are in use.
+        """
+        self.lock.acquire()
+        try:
+            self.close_idle()
+            deadline = time.time() + self.wait_timeout
+            while 1:
+                if self.idle[readonly]:
+                    return self.idle[readonly].pop()[0]
+                if self.open_count[readonly] < self.limit(readonly):
+                    self.open_count[readonly] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No connection to %s free after %s seconds"
+                        % (self.db_filename, self.wait_timeout))
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+        try:
+            return self.connect(readonly)
+        except:
+            self.lock.acquire()
+            try:
+                self.open_count[readonly] -= 1
+                self.lock.notify()
+            finally:
+                self.lock.release()
+            raise
+
+    def release(self, conn, readonly=False):
+        self.lock.acquire()
+        try:
+            self.idle[readonly].append((conn, time.time()))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def connect(self, readonly):
+        # (Imported here, so the memory index can use sqliteindex's
+        # helpers without pysqlite2)
+        from pysqlite2.dbapi2 import connect
+        conn = connect(self.db_filename, isolation_level=None,
+                       timeout=self.busy_timeout, check_same_thread=False)
+        if not readonly and self.journal_mode:
+            # This sticks to the database file
+            conn.execute('PRAGMA journal_mode = %s' % self.journal_mode)
+        for name, value in sorted(self.pragmas.items()):
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        if readonly:
+            conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def close_idle(self):
+        """
+        Closes connections that haven't been used in
+        ``idle_timeout`` seconds.  Call with the lock held.
+        """
+        cutoff = time.time() - self.idle_timeout
+        for readonly, idle in self.idle.items():
+            while idle and idle[0][1] < cutoff:
+                conn, released = idle.pop(0)
+                conn.close()
+                self.open_count[readonly] -= 1
+
+    def close(self):
+        """
+        Closes all the idle connections
+        """
+        self.lock.acquire()
+        try:
+            for readonly, idle in self.idle.items():
+                for conn, released in idle:
+                    conn.close()
+                    self.open_count[readonly] -= 1
+                del idle[:]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict(
+                readers=self.open_count[True],
+                idle_readers=len(self.idle[True]),
+                writers=self.open_count[False],
+                idle_writers=len(self.idle[False]))
+        finally:
+            self.lock.release()
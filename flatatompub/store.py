@@ -1,42 +1,224 @@
 import os
 import re
 import md5
+import hashlib
+import shutil
+import errno
+import thread
+import time
+import fcntl
 from taggerclient import atom
 import mimetypes
+from copy import deepcopy
 from itertools import count
 from datetime import datetime
 from webob import UTC
+from flatatompub.lrucache import LRUCache
+from flatatompub.mediameta import SidecarMediaMetadata, SQLiteMediaMetadata
 
 safe_slug_re = re.compile(r'^[a-z0-9_.-]+$', re.I)
 unsafe_slug_re = re.compile(r'[^a-z0-9_.-]', re.I)
 sep_re = re.compile(r'[ .]')
+shard_dir_re = re.compile(r'^[0-9a-f]{2}$')
+digest_re = re.compile(r'^[0-9a-f]{64}$')
+# (An md5 digest is 16 bytes)
+max_shard_depth = 16
+# The Atom namespace declared on the root of a serialized entry:
+entry_ns_re = re.compile(
+    r'^(<entry\b[^>]*?)\s+xmlns="%s"' % re.escape(atom.atom_ns))
 
 bad_slugs = ['service', 'media']
 
-last_id_creation = None
-id_counter = count(1)
+# Parsed entries take up roughly this many times their serialized
+# size in memory:
+parsed_size_factor = 10
 
-def create_slug():
-    global last_id_creation, id_counter
-    create_date = datetime.utcnow().strftime('%Y-%m-%d')
-    if last_id_creation != create_date:
-        last_id_creation = create_date
-        # Reset counter
-        id_counter = count(1)
-    while 1:
-        fn = create_date + '-%s' % id_counter.next()
-        yield fn
+# Per-file metadata that sits next to the file itself:
+entry_sidecars = ['.etag']
+media_sidecars = ['.content-type', '.entry-slug', '.etag', '.digest',
+                  '.mtime']
+
+temp_counter = count(1)
 
 def ensure_exists(dir):
     if not os.path.exists(dir):
         print 'Creating directory %s' % dir
         os.makedirs(dir)
 
-def clear_files(dir):
-    for fn in os.listdir(dir):
-        fn = os.path.join(dir, fn)
-        if not os.path.isdir(fn):
+def ensure_parent(fn):
+    dir = os.path.dirname(fn)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+
+def clear_files(dir, keep=(), depth=0):
+    """
+    Removes the files in ``dir`` (except the names in ``keep``), and
+    the files in its shard subdirectories down to ``depth`` levels.
+    Other subdirectories are left alone.
+    """
+    for name in os.listdir(dir):
+        fn = os.path.join(dir, name)
+        if name in keep or os.path.isdir(fn):
+            continue
+        os.unlink(fn)
+    removed = []
+    for file_depth, name, fn in walk_shards(dir, depth, True):
+        if file_depth:
             os.unlink(fn)
+            removed.append(fn)
+    remove_empty_parents(removed, dir)
+
+def walk_shards(dir, max_depth, include_sidecars=False):
+    """
+    Returns ``[(depth, name, filename)]`` for the files in ``dir``
+    (at depth 0) and in its shard subdirectories, down to
+    ``max_depth`` levels.  Hidden files, and sidecar files unless
+    ``include_sidecars`` is true, are left out.
+
+    A subdirectory is only taken to be a shard if everything in it
+    belongs there (see `shard_path`), so directories that just have
+    names like shards (``db``, say) are left alone.
+    """
+    files = []
+    for name in os.listdir(dir):
+        if name.startswith('.'):
+            continue
+        fn = os.path.join(dir, name)
+        if os.path.isdir(fn):
+            if max_depth and shard_dir_re.search(name):
+                files.extend(shard_files(fn, [name], max_depth,
+                                         include_sidecars) or [])
+            continue
+        if include_sidecars or slug_for_name(name) == name:
+            files.append((0, name, fn))
+    return files
+
+def shard_files(dir, parts, max_depth, include_sidecars=False):
+    """
+    Returns the files in the shard directory ``dir`` (which is at
+    the shard path ``parts``) like `walk_shards`, or None if it
+    isn't really a shard.
+    """
+    files = []
+    for name in os.listdir(dir):
+        if name.startswith('.'):
+            # Temporary files
+            continue
+        fn = os.path.join(dir, name)
+        if os.path.isdir(fn):
+            if len(parts) >= max_depth or not shard_dir_re.search(name):
+                return None
+            sub_files = shard_files(fn, parts + [name], max_depth,
+                                    include_sidecars)
+            if sub_files is None:
+                return None
+            files.extend(sub_files)
+            continue
+        slug = slug_for_name(name)
+        if shard_path(slug, len(parts)) != os.path.join(*parts):
+            return None
+        if include_sidecars or slug == name:
+            files.append((len(parts), name, fn))
+    return files
+
+def iter_files(dir, depth=0, include_sidecars=False):
+    """
+    Yields ``(name, filename)`` for every file in ``dir``, and in
+    its shard subdirectories for a store with the given shard
+    ``depth`` (see `walk_shards`).
+    """
+    for file_depth, name, fn in walk_shards(dir, depth, include_sidecars):
+        if file_depth in (0, depth):
+            yield name, fn
+
+def detect_shard_depth(dir):
+    """
+    Returns the shard depth the files in ``dir`` are kept at (the
+    deepest one, if the layout is being migrated), or 0 for the flat
+    layout
+    """
+    depth = 0
+    for file_depth, name, fn in walk_shards(dir, max_shard_depth, True):
+        depth = max(depth, file_depth)
+    return depth
+
+def shard_path(slug, depth):
+    """
+    Returns the fan-out subdirectory for ``slug``, like ``'3f/a2'``
+    for a depth of 2, or ``''`` for the flat layout (depth 0).
+    """
+    if not depth:
+        return ''
+    h = md5.new(slug).hexdigest()
+    return os.path.join(*[h[i*2:i*2+2] for i in range(depth)])
+
+def slug_for_name(name):
+    """
+    Returns the slug a file in a store directory belongs to (sidecar
+    files belong to their media file)
+    """
+    for ext in media_sidecars:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def temp_filename(fn):
+    """
+    Returns a new, unique filename next to ``fn``, for a temporary
+    file that will later be renamed over it.
+    """
+    dir, name = os.path.split(fn)
+    return os.path.join(dir, '.tmp-%s-%s-%s' % (
+        os.getpid(), thread.get_ident(), temp_counter.next()))
+
+def open_temp(fn):
+    """
+    Opens a new temporary file (as a file descriptor) next to
+    ``fn``.  Returns ``(fd, tmp_filename)``.
+    """
+    while 1:
+        tmp_fn = temp_filename(fn)
+        try:
+            fd = os.open(tmp_fn, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            return fd, tmp_fn
+
+def write_file(fn, data):
+    """
+    Writes a file by renaming a temporary file over it, so readers
+    never see a partial file.  Returns the ``os.stat()`` of the new
+    file.
+    """
+    fd, tmp_fn = open_temp(fn)
+    try:
+        try:
+            os.write(fd, data)
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+    return st
+
+def remove_empty_parents(filenames, top):
+    """
+    Removes the directories the (removed or moved) ``filenames``
+    were in, and their parents up to ``top``, if they are now empty
+    """
+    for fn in filenames:
+        dir = os.path.dirname(fn)
+        while dir.startswith(top + os.path.sep):
+            try:
+                os.rmdir(dir)
+            except OSError:
+                # Not empty
+                break
+            dir = os.path.dirname(dir)
 
 def ext_for_mimetype(type):
     ext = mimetypes.guess_extension(type.split(';')[0])
@@ -47,13 +229,46 @@ def ext_for_mimetype(type):
         ext = '.jpg'
     return ext
 
-def copyfile(infile, outfile, length):
-    while length:
-        chunk = infile.read(min(length, 4096))
+def make_fragment(data):
+    """
+    Turns a serialized entry into a fragment that can be put as-is
+    into a feed that declares the Atom namespace.
+    """
+    if data.startswith('<?xml'):
+        data = data.split('?>', 1)[1]
+    data = data.strip()
+    return entry_ns_re.sub(r'\1', data, 1)
+
+def file_md5(f):
+    h = md5.new()
+    while 1:
+        chunk = f.read(65536)
         if not chunk:
             break
-        length -= len(chunk)
-        outfile.write(chunk)
+        h.update(chunk)
+    return h.hexdigest()
+
+def copyfile(infile, outfile, length, chunk_size=65536, hashes=()):
+    """
+    Copies ``length`` bytes (or everything, if length is None) to
+    outfile, updating each of the ``hashes`` objects as it goes.  If
+    outfile is None the data is only read (and hashed).  Returns the
+    number of bytes copied.
+    """
+    size = 0
+    while length is None or size < length:
+        if length is None:
+            chunk = infile.read(chunk_size)
+        else:
+            chunk = infile.read(min(length - size, chunk_size))
+        if not chunk:
+            break
+        size += len(chunk)
+        for h in hashes:
+            h.update(chunk)
+        if outfile is not None:
+            outfile.write(chunk)
+    return size
 
 class StoredEntry(object):
 
@@ -85,11 +300,19 @@ class StoredEntry(object):
             meth = self.store.index.entry_added
         else:
             meth = self.store.index.entry_updated
-        new_entry = self.store.index.rewrite_entry(self.slug, self.atom_entry)
+        try:
+            new_entry = self.store.index.rewrite_entry(
+                self.slug, self.atom_entry)
+        except:
+            if created:
+                self.store.release_slug(self.slug, 'entry')
+                self.slug = None
+            raise
         if new_entry is not None:
             self.atom_entry = new_entry
         meth(self.slug, self.atom_entry)
         self.store.save_entry(self.slug, self.atom_entry)
+        self.store.entry_changed(self.slug)
 
     def confirm_slug(self):
         found = False
@@ -110,6 +333,7 @@ class StoredEntry(object):
                 media.delete(delete_entry=False)
         self.store.index.entry_deleted(self.slug, self.atom_entry)
         self.store.delete_entry(self.slug)
+        self.store.entry_changed(self.slug)
 
     @property
     def etag(self):
@@ -124,7 +348,8 @@ class StoredEntry(object):
         result = []
         for link in self.atom_entry.rel_links('edit-media'):
             media = self.store.get_media_by_link(link.href)
-            if media is not None and media.entry.slug == self.slug:
+            if (media is not None
+                and media.info.get('entry_slug') == self.slug):
                 result.append(media)
         return result
 
@@ -141,9 +366,19 @@ class StoredMedia(object):
             raise TypeError(
                 "You cannot give a suggest_slug and slug argument")
         self.suggest_slug = suggest_slug
+        self._info = None
         if entry is not None:
             self.entry = entry
 
+    @property
+    def info(self):
+        """
+        What the store knows about this media (looked up only once)
+        """
+        if self._info is None:
+            self._info = self.store.media_info(self.slug)
+        return self._info
+
     def create(self, content_type):
         if self.slug is None:
             ext = ext_for_mimetype(content_type)
@@ -152,12 +387,15 @@ class StoredMedia(object):
         self.store.touch_media(self.slug)
         self.content_type = content_type
 
-    def copy_file(self, fp, content_length=None):
-        out = self.store.open_media(self.slug, 'wb')
-        if content_length is None:
-            shutil.copyfileobj(fp, out)
-        else:
-            copyfile(fp, out, content_length)
+    def copy_file(self, fp, content_length=None, sha256=None):
+        """
+        Replaces the content with ``content_length`` bytes read from
+        ``fp`` (or everything up to EOF, if content_length is None).
+        The old content stays in place until the upload is complete.
+        ``sha256`` is the hex digest of the content, if known.
+        """
+        self.store.write_media(self.slug, fp, content_length, sha256)
+        self._info = None
         if self.entry:
             # Update mtime and edited time
             self.entry.save()
@@ -171,7 +409,7 @@ class StoredMedia(object):
         return self.store.get_filename(self.slug, 'media')
 
     def entry__get(self):
-        entry_slug = self.store.get_media_entry(self.slug)
+        entry_slug = self.info.get('entry_slug')
         if not entry_slug:
             return None
         return self.store.get_entry(entry_slug)
@@ -179,12 +417,15 @@ class StoredMedia(object):
         if not isinstance(value, basestring):
             value = value.slug
         self.store.set_media_entry(self.slug, value)
+        self._info = None
     entry = property(entry__get, entry__set)
 
     def content_type__get(self):
-        return self.store.get_media_content_type(self.slug)
+        return (self.info.get('content_type')
+                or mimetypes.guess_type(self.slug)[0])
     def content_type__set(self, value):
         self.store.set_media_content_type(self.slug, value)
+        self._info = None
     content_type = property(content_type__get, content_type__set)
 
     def delete(self, delete_entry=True):
@@ -194,29 +435,57 @@ class StoredMedia(object):
 
     @property
     def etag(self):
-        return self.store.etag(self.slug, 'media')
+        return self.info.get('etag') or self.store.etag(self.slug, 'media')
 
     @property
     def last_modified(self):
         return self.store.last_modified(self.slug, 'media')
 
-class Store(object):
+class FileInfo(object):
+    """
+    What is needed to serve a stored file, gathered once
+    """
+
+    def __init__(self, filename, size, mtime, etag):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+
+    @property
+    def last_modified(self):
+        return datetime.fromtimestamp(self.mtime, UTC)
+
+class BaseStore(object):
+    """
+    The interface a store implements, with the parts that don't depend
+    on how things are stored.  Entries are kept by slug, as serialized
+    Atom; media is kept by slug as files (in ``media_dir``) with a
+    little metadata.  Subclasses must implement the methods that raise
+    NotImplementedError.
+
+    Stores are created by factories in the
+    ``flatatompub.store_factory`` entry point group, which are called
+    like ``factory(global_conf, data_dir, index, **options)``.
+    """
 
     EntryClass = StoredEntry
     MediaClass = StoredMedia
 
-    def __init__(self, data_dir, media_dir=None, page_limit=None, index=None):
+    def __init__(self, index=None, entry_cache_size=1000,
+                 entry_cache_bytes=64*1024*1024,
+                 fragment_cache_bytes=16*1024*1024):
         if index is None:
             raise TypeError("You must provide an index")
         self.index = index
-        data_dir = os.path.normpath(data_dir)
-        if media_dir is None:
-            media_dir = os.path.join(data_dir, 'media')
-        self.data_dir = data_dir
-        self.media_dir = media_dir
-        ensure_exists(self.data_dir)
-        ensure_exists(self.media_dir)
-        self.page_limit = page_limit
+        # Parsed entries, keyed by slug; values are
+        # ``(stamp, atom_entry)``:
+        self.entry_cache = LRUCache(entry_cache_size, entry_cache_bytes)
+        # Feed fragments (see `entry_fragment`), kept the same way:
+        self.fragment_cache = LRUCache(entry_cache_size, fragment_cache_bytes)
+        # Rendered feeds (a `flatatompub.responsecache.ResponseCache`),
+        # if they are cached:
+        self.response_cache = None
 
     def get_entry(self, slug):
         return self.EntryClass(
@@ -225,41 +494,35 @@ class Store(object):
     def get_media(self, slug):
         return self.MediaClass(self, slug)
 
-    def clear(self):
-        self.index.clear()
-        clear_files(self.data_dir)
-        clear_files(self.media_dir)
+    def get_media_by_link(self, link):
+        if 'media/' not in link:
+            # Not recognized
+            return None
+        pos = link.find('media/') + len('media/')
+        slug = link[pos:]
+        media = self.get_media(slug)
+        return media
 
     def create_slug(self, suggest, type, ext):
         if suggest:
             suggest = suggest.split('.', 1)[0]
             suggest = sep_re.sub(' ', suggest)
             suggest = unsafe_slug_re.sub('', suggest)
+        if suggest:
+            # (an empty suggestion would give a hidden file, like .jpg)
             suggest += ext
             try:
                 self.assert_good_slug(suggest)
             except ValueError:
                 pass
             else:
-                fn = self.get_filename(suggest, type)
-                if not os.path.exists(fn):
+                if self.reserve_slug(suggest, type):
                     return suggest
-        for slug in create_slug():
-            slug += ext
-            fn = self.get_filename(slug, type)
-            if not os.path.exists(fn):
+        while 1:
+            slug = self.next_slug() + ext
+            if self.reserve_slug(slug, type):
                 return slug
 
-    def get_filename(self, slug, type):
-        if type == 'entry':
-            base = self.data_dir
-        elif type == 'media':
-            base = self.media_dir
-        else:
-            assert 0, 'bad type: %r' % type
-        self.assert_good_slug(slug)
-        return os.path.join(base, slug)
-
     def assert_good_slug(self, slug):
         if not slug:
             raise ValueError(
@@ -273,131 +536,802 @@ class Store(object):
         if slug.lower() in bad_slugs:
             raise ValueError(
                 "Reserved slug: %r" % slug)
+        if slug.startswith('.'):
+            # Temporary and bookkeeping files, like .collection
+            raise ValueError(
+                "Hidden slug: %r" % slug)
+        for ext in entry_sidecars + media_sidecars:
+            if slug.endswith(ext):
+                raise ValueError(
+                    "Slug looks like a sidecar file: %r" % slug)
+
+    def next_slug(self):
+        """
+        Returns a new unique-looking slug (without any extension)
+        """
+        raise NotImplementedError
+
+    def reserve_slug(self, slug, type):
+        """
+        Claims the slug (``type`` is ``'entry'`` or ``'media'``), returning
+        False if it is already taken.  A reserved entry doesn't exist until
+        it is saved.
+        """
+        raise NotImplementedError
+
+    def release_slug(self, slug, type):
+        """
+        Gives up a slug reserved with `reserve_slug` that was never used
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Removes everything from the store (and the index)
+        """
+        raise NotImplementedError
+
+    ############################################################
+    ## Entries
+    ############################################################
+
+    def entry_changed(self, slug):
+        """
+        Called after an entry is saved or deleted
+        """
+        self.fragment_cache.remove(slug)
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
+
+    def load_entry(self, slug):
+        """
+        Returns the parsed entry.  Parsed entries are cached; you
+        always get a copy that you may modify.
+        """
+        stamp = self.entry_stamp(slug)
+        cached = self.entry_cache.get(slug)
+        if cached is not None and cached[0] == stamp:
+            return deepcopy(cached[1])
+        v = atom.ATOM(self.read_entry(slug))
+        assert isinstance(v, atom.Entry)
+        self.entry_cache.set(slug, (stamp, v),
+                             stamp[1] * parsed_size_factor)
+        return deepcopy(v)
+
+    def entry_fragment(self, slug):
+        """
+        Returns the serialized entry, ready to be put into a feed (the
+        Atom namespace declaration is left off).  Fragments are
+        cached, so feeds can be put together without parsing or
+        serializing entries.
+        """
+        stamp = self.entry_stamp(slug)
+        cached = self.fragment_cache.get(slug)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        fragment = make_fragment(self.read_entry(slug))
+        self.fragment_cache.set(slug, (stamp, fragment), len(fragment))
+        return fragment
+
+    def entry_stamp(self, slug):
+        """
+        Returns a value that changes whenever the entry changes, a
+        tuple that starts with ``(mtime, size)``.  Raises KeyError if
+        there is no such entry.
+        """
+        raise NotImplementedError
+
+    def read_entry(self, slug):
+        """
+        Returns the serialized entry.  Raises KeyError if there is no such
+        entry.
+        """
+        raise NotImplementedError
+
+    def open_entry(self, slug):
+        """
+        Returns ``(fp, info)``: a file-like object with the serialized entry,
+        and a `FileInfo` for it (the filename may be None).  Raises KeyError
+        if there is no such entry.
+        """
+        raise NotImplementedError
+
+    def save_entry(self, slug, atom_entry):
+        raise NotImplementedError
+
+    def delete_entry(self, slug):
+        raise NotImplementedError
+
+    def touch_entry(self, slug):
+        """
+        Makes sure the slug is taken, without saving anything
+        """
+        raise NotImplementedError
 
     def etag(self, slug, type):
+        raise NotImplementedError
+
+    def set_etag(self, slug, type, etag):
+        raise NotImplementedError
+
+    def last_modified(self, slug, type):
+        """
+        Returns the (UTC) datetime the entry or media was last written
+        """
+        raise NotImplementedError
+
+    ############################################################
+    ## Media
+    ############################################################
+
+    def get_filename(self, slug, type, ext=''):
+        """
+        Returns the filename for the slug (``ext`` gives a sidecar
+        file kept next to it).  Media is served from this file.
+        """
+        raise NotImplementedError
+
+    def touch_media(self, slug):
+        raise NotImplementedError
+
+    def open_media(self, slug, mode):
+        raise NotImplementedError
+
+    def write_media(self, slug, fp, length=None, sha256=None):
+        """
+        Stores the media read from ``fp``, returning the number of bytes
+        written.  Raises ValueError if fp ends before ``length`` bytes, or
+        doesn't match the ``sha256`` digest.
+        """
+        raise NotImplementedError
+
+    def media_info(self, slug):
+        """
+        Returns a dictionary of what is known about the media (see
+        `flatatompub.mediameta`).
+        """
+        raise NotImplementedError
+
+    def get_media_digest(self, slug):
+        """
+        Returns the SHA-256 digest of the blob the media is stored in,
+        or None if it isn't stored in a blob.
+        """
+        return self.media_info(slug).get('digest')
+
+    def get_media_entry(self, slug):
+        return self.media_info(slug).get('entry_slug')
+
+    def set_media_entry(self, media_slug, entry_slug):
+        raise NotImplementedError
+
+    def get_media_content_type(self, slug):
+        return (self.media_info(slug).get('content_type')
+                or mimetypes.guess_type(slug)[0])
+
+    def set_media_content_type(self, slug, content_type):
+        raise NotImplementedError
+
+    def delete_media(self, slug):
+        raise NotImplementedError
+
+    ############################################################
+    ## Feeds
+    ############################################################
+
+    def entry_slugs(self):
+        """
+        Returns the slugs of all the entries, most recently changed first
+        """
+        raise NotImplementedError
+
+    def most_recent(self):
+        return self.collection_state()[1]
+
+    def collection_state(self):
+        """
+        Returns ``(version, last_changed)``.  The version goes up every time
+        an entry is saved or deleted, and last_changed is the (UTC) datetime
+        of the last such change.
+        """
+        raise NotImplementedError
+
+    def collection_changed(self, version=None):
+        """
+        Bumps the collection version (starting from ``version``, if given)
+        and last-changed time.
+        """
+        raise NotImplementedError
+
+class Store(BaseStore):
+    """
+    The filesystem store: each entry is a file in ``data_dir``, and
+    each media item a file in ``media_dir``.
+    """
+
+    def __init__(self, data_dir, media_dir=None, page_limit=None, index=None,
+                 shard_depth=0, entry_cache_size=1000,
+                 entry_cache_bytes=64*1024*1024,
+                 upload_chunk_size=1024*1024, media_dedup=False,
+                 media_metadata='sidecar', fragment_cache_bytes=16*1024*1024):
+        BaseStore.__init__(self, index, entry_cache_size, entry_cache_bytes,
+                           fragment_cache_bytes)
+        data_dir = os.path.normpath(data_dir)
+        if media_dir is None:
+            media_dir = os.path.join(data_dir, 'media')
+        self.data_dir = data_dir
+        self.media_dir = media_dir
+        ensure_exists(self.data_dir)
+        ensure_exists(self.media_dir)
+        self.page_limit = page_limit
+        # With a shard_depth, files are kept in fan-out
+        # subdirectories like data_dir/3f/a2/slug:
+        self.shard_depth = shard_depth
+        self.upload_chunk_size = upload_chunk_size
+        # With media_dedup, media content is stored once per SHA-256
+        # digest in media_dir/.blobs, and each media file is a hard
+        # link to its blob (so the blob's link count is its reference
+        # count):
+        self.media_dedup = media_dedup
+        self.blob_dir = os.path.join(self.media_dir, '.blobs')
+        if media_metadata == 'sidecar':
+            self.media_metadata = SidecarMediaMetadata(self)
+        elif media_metadata == 'sqlite':
+            self.media_metadata = SQLiteMediaMetadata(
+                os.path.join(self.media_dir, '.metadata.sqlite'),
+                fallback=SidecarMediaMetadata(self))
+        else:
+            raise ValueError(
+                "Unknown media_metadata: %r" % media_metadata)
+
+    def clear(self):
+        self.index.clear()
+        self.entry_cache.clear()
+        self.fragment_cache.clear()
+        version, last_changed = self.collection_state()
+        clear_files(self.data_dir, depth=self.shard_depth)
+        keep = ()
+        if isinstance(self.media_metadata, SQLiteMediaMetadata):
+            # The database is emptied, not removed (it's still open):
+            name = os.path.basename(self.media_metadata.db_filename)
+            keep = [name + ext for ext in ['', '-journal', '-wal', '-shm']]
+        clear_files(self.media_dir, keep, self.shard_depth)
+        if os.path.exists(self.blob_dir):
+            shutil.rmtree(self.blob_dir)
+        if isinstance(self.media_metadata, SQLiteMediaMetadata):
+            self.media_metadata.clear()
+        self.collection_changed(version)
+
+    def next_slug(self):
+        """
+        Returns a new slug like ``2008-01-20-5``, from a per-day
+        counter kept in the data directory.  The counter is shared by
+        all processes using the store.
+        """
+        fn = os.path.join(self.data_dir, '.slug-counter')
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        fd = os.open(fn, os.O_RDWR|os.O_CREAT, 0666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 100).split()
+            if len(data) == 2 and data[0] == today:
+                counter = int(data[1]) + 1
+            else:
+                counter = 1
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%s %s' % (today, counter))
+        finally:
+            # This also releases the lock
+            os.close(fd)
+        return '%s-%s' % (today, counter)
+
+    def reserve_slug(self, slug, type):
+        """
+        Creates an empty file for the slug, returning False if it is
+        already taken.  An empty entry file is treated as not existing
+        (until the entry is saved).
+        """
         fn = self.get_filename(slug, type)
-        if os.path.getsize(fn) > 4096:
-            # Large files get a simple mtime + bytes + path
-            etag = '%s-%s-%s' % (
-                os.path.getmtime(fn),
-                os.path.getsize(fn),
-                hash(fn))
-            return etag
+        ensure_parent(fn)
+        try:
+            fd = os.open(fn, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        os.close(fd)
+        return True
+
+    def release_slug(self, slug, type):
+        """
+        Gives up a slug reserved with `reserve_slug` that was never used
+        """
+        fn = self.get_filename(slug, type)
+        if os.path.exists(fn) and not os.path.getsize(fn):
+            os.unlink(fn)
+
+    def get_filename(self, slug, type, ext=''):
+        """
+        Returns the filename for the slug.  ``ext`` gives a sidecar
+        file that is kept alongside the main file.
+
+        With a ``shard_depth``, files that are still in the flat
+        layout (not yet migrated) are found in their old location.
+        """
+        base = self.base_dir(type)
+        self.assert_good_slug(slug)
+        if not self.shard_depth:
+            return os.path.join(base, slug + ext)
+        fn = os.path.join(base, shard_path(slug, self.shard_depth), slug + ext)
+        if not os.path.exists(fn):
+            flat_fn = os.path.join(base, slug + ext)
+            if os.path.exists(flat_fn):
+                return flat_fn
+        return fn
+
+    def base_dir(self, type):
+        if type == 'entry':
+            return self.data_dir
+        elif type == 'media':
+            return self.media_dir
         else:
-            f = open(fn, 'rb')
-            h = md5.new(f.read())
+            assert 0, 'bad type: %r' % type
+
+    def migrate_layout(self, type, verbose=False):
+        """
+        Moves all the files of the given type into the location
+        given by the current ``shard_depth``.  Files are renamed one
+        at a time, so the store can keep serving while this runs.
+
+        Returns the number of files moved.
+        """
+        base = self.base_dir(type)
+        moved = []
+        for depth, name, fn in walk_shards(base, max_shard_depth, True):
+            dest = os.path.join(
+                base, shard_path(slug_for_name(name), self.shard_depth), name)
+            if dest == fn:
+                continue
+            if verbose:
+                print 'Moving %s to %s' % (fn, dest)
+            ensure_parent(dest)
+            os.rename(fn, dest)
+            moved.append(fn)
+        remove_empty_parents(moved, base)
+        return len(moved)
+
+    def etag(self, slug, type):
+        """
+        Returns the ETag, which is computed when the file is written.
+        (For files written before ETags were stored, it is computed
+        and stored on first use.)
+        """
+        if type == 'entry':
+            f = open(self.get_filename(slug, type), 'rb')
+            try:
+                return self.entry_etag(slug, f)
+            finally:
+                f.close()
+        etag = self.media_info(slug).get('etag')
+        if etag:
+            return etag
+        f = open(self.get_filename(slug, type), 'rb')
+        try:
+            etag = file_md5(f)
+        finally:
             f.close()
-            return h.hexdigest()
+        self.set_etag(slug, type, etag)
+        return etag
+
+    def entry_etag(self, slug, fp):
+        """
+        Returns the ETag of the entry body open as ``fp``.
+
+        The .etag file holds the ETag and the inode of the body it
+        belongs to, so if the entry was saved again after fp was
+        opened (or is being saved right now) the ETag of fp is
+        computed instead, and an ETag is never given out with the
+        wrong body.
+        """
+        st = os.fstat(fp.fileno())
+        etag_fn = self.get_filename(slug, 'entry', '.etag')
+        try:
+            f = open(etag_fn, 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                parts = f.read().split()
+            finally:
+                f.close()
+            if len(parts) == 2 and parts[1] == str(st.st_ino):
+                return parts[0]
+        pos = fp.tell()
+        fp.seek(0)
+        etag = file_md5(fp)
+        fp.seek(pos)
+        if st.st_size:
+            # (Reserved entries are empty, and not really there yet)
+            try:
+                current = os.stat(self.get_filename(slug, 'entry'))
+            except OSError:
+                current = None
+            if current is not None and current.st_ino == st.st_ino:
+                write_file(etag_fn, '%s %s' % (etag, st.st_ino))
+        return etag
+
+    def set_etag(self, slug, type, etag):
+        if type == 'media':
+            self.media_metadata.set(slug, etag=etag)
+            return
+        fn = self.get_filename(slug, type)
+        write_file(self.get_filename(slug, type, '.etag'),
+                   '%s %s' % (etag, os.stat(fn).st_ino))
 
     def last_modified(self, slug, type):
+        if type == 'media':
+            info = self.media_info(slug)
+            if info.get('digest') and info.get('mtime'):
+                # Stored in a shared blob (see write_media)
+                return datetime.fromtimestamp(float(info['mtime']), UTC)
         fn = self.get_filename(slug, type)
         t = os.path.getmtime(fn)
         t = datetime.fromtimestamp(t, UTC)
         return t
 
-    def load_entry(self, slug):
+    def open_entry(self, slug):
+        """
+        Returns ``(fp, info)`` for the stored entry, where ``fp`` is
+        the open file of the serialized entry and ``info`` is a
+        `FileInfo` for exactly that file.  Raises KeyError if there is
+        no such entry.
+        """
         fn = self.get_filename(slug, 'entry')
-        if not os.path.exists(fn):
+        try:
+            fp = open(fn, 'rb')
+        except IOError:
             raise KeyError(fn)
-        f = open(fn, 'rb')
+        st = os.fstat(fp.fileno())
+        if not st.st_size:
+            # Only reserved
+            fp.close()
+            raise KeyError(fn)
+        info = FileInfo(fn, st.st_size, st.st_mtime,
+                        self.entry_etag(slug, fp))
+        return fp, info
+
+    def entry_stamp(self, slug):
+        """
+        Returns ``(mtime, size, inode, ctime)`` of the stored entry,
+        which changes whenever the entry changes.  Raises KeyError if
+        there is no such entry.
+
+        Every save writes a new file (see `write_file`), so the inode
+        changes even when another process saves an entry of the same
+        size within the same mtime tick.
+        """
+        fn = self.get_filename(slug, 'entry')
         try:
-            v = atom.ATOM(f.read())
-            assert isinstance(v, atom.Entry)
-            return v
-        finally:
-            f.close()
+            st = os.stat(fn)
+        except OSError:
+            raise KeyError(fn)
+        if not st.st_size:
+            # Only reserved
+            raise KeyError(fn)
+        return (st.st_mtime, st.st_size, st.st_ino, st.st_ctime)
 
-    def save_entry(self, slug, atom_entry):
+    def read_entry(self, slug):
+        """
+        Returns the serialized entry.  Raises KeyError if there is no
+        such entry.
+        """
         fn = self.get_filename(slug, 'entry')
-        f = open(fn, 'wb')
         try:
-            f.write(atom.tostring(atom_entry))
+            f = open(fn, 'rb')
+        except IOError:
+            raise KeyError(fn)
+        try:
+            data = f.read()
         finally:
             f.close()
+        if not data:
+            # Only reserved
+            raise KeyError(fn)
+        return data
+
+    def save_entry(self, slug, atom_entry):
+        fn = self.get_filename(slug, 'entry')
+        ensure_parent(fn)
+        self.entry_cache.remove(slug)
+        body = atom.tostring(atom_entry)
+        st = write_file(fn, body)
+        # Tied to this body (see `entry_etag`), so readers never pair
+        # it with the old one, whatever order they see these in:
+        write_file(self.get_filename(slug, 'entry', '.etag'),
+                   '%s %s' % (md5.new(body).hexdigest(), st.st_ino))
+        self.collection_changed()
 
     def delete_entry(self, slug):
         fn = self.get_filename(slug, 'entry')
+        self.entry_cache.remove(slug)
         os.unlink(fn)
-
-    def get_media_by_link(self, link):
-        if 'media/' not in link:
-            # Not recognized
-            return None
-        pos = link.find('media/') + len('media/')
-        slug = link[pos:]
-        media = self.get_media(slug)
-        return media
+        for ext in entry_sidecars:
+            fn = self.get_filename(slug, 'entry', ext)
+            if os.path.exists(fn):
+                os.unlink(fn)
+        self.collection_changed()
 
     def touch_media(self, slug):
         fn = self.get_filename(slug, 'media')
+        ensure_parent(fn)
         f = open(fn, 'a')
         f.close()
 
     def touch_entry(self, slug):
         fn = self.get_filename(slug, 'entry')
+        ensure_parent(fn)
         f = open(fn, 'a')
         f.close()
 
     def open_media(self, slug, mode):
         fn = self.get_filename(slug, 'media')
+        if 'r' not in mode:
+            ensure_parent(fn)
         return open(fn, mode)
 
-    def get_media_entry(self, slug):
-        fn = self.get_filename(slug, 'media') + '.entry-slug'
-        if not os.path.exists(fn):
+    def write_media(self, slug, fp, length=None, sha256=None):
+        """
+        Writes the media from ``fp`` through a temporary file that is
+        renamed into place at the end, computing the ETag as it goes.
+        Raises ValueError if fp ends before ``length`` bytes.  Returns
+        the number of bytes written.
+
+        With ``media_dedup``, ``sha256`` may give the (hex) digest the
+        client says the content has; if that content is already
+        stored the upload is only read and checked, not written.
+        """
+        fn = self.get_filename(slug, 'media')
+        ensure_parent(fn)
+        etag_hash = md5.new()
+        hashes = [etag_hash]
+        digest = None
+        if self.media_dedup:
+            content_hash = hashlib.sha256()
+            hashes.append(content_hash)
+        tmp_fn = None
+        if self.media_dedup and sha256:
+            tmp_fn = self.link_blob(sha256.lower(), fn)
+        try:
+            if tmp_fn is not None:
+                # Already stored; tmp_fn keeps the blob alive meanwhile
+                size = copyfile(fp, None, length, self.upload_chunk_size,
+                                hashes)
+            else:
+                fd, tmp_fn = open_temp(fn)
+                out = os.fdopen(fd, 'wb', 0)
+                try:
+                    size = copyfile(fp, out, length, self.upload_chunk_size,
+                                    hashes)
+                finally:
+                    out.close()
+            if length is not None and size < length:
+                raise ValueError(
+                    "Upload ended after %s of %s bytes" % (size, length))
+            if self.media_dedup:
+                digest = content_hash.hexdigest()
+                if sha256 and sha256.lower() != digest:
+                    raise ValueError(
+                        "Upload does not match its SHA-256 digest %s" % sha256)
+                tmp_fn = self.share_blob(tmp_fn, digest)
+            old_digest = self.get_media_digest(slug)
+            os.rename(tmp_fn, fn)
+        except:
+            if tmp_fn is not None and os.path.exists(tmp_fn):
+                os.unlink(tmp_fn)
+            raise
+        if digest:
+            # The file is the shared blob, with the blob's mtime
+            mtime = time.time()
+        else:
+            mtime = os.path.getmtime(fn)
+        self.media_metadata.set(
+            slug, etag=etag_hash.hexdigest(), digest=digest,
+            size=size, mtime=mtime)
+        if old_digest and old_digest != digest:
+            self.release_blob(old_digest)
+        return size
+
+    def blob_filename(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def link_blob(self, digest, fn):
+        """
+        Makes a new temporary hard link (next to ``fn``) to the blob
+        for ``digest``, returning its filename, or None if there is no
+        such blob.
+        """
+        if not digest_re.search(digest):
             return None
-        f = open(fn, 'r')
+        link_fn = temp_filename(fn)
         try:
-            return f.read().strip()
-        finally:
-            f.close()
+            os.link(self.blob_filename(digest), link_fn)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return link_fn
 
-    def set_media_entry(self, media_slug, entry_slug):
-        fn = self.get_filename(media_slug, 'media') + '.entry-slug'
-        f = open(fn, 'w')
-        f.write(entry_slug)
-        f.close()
+    def share_blob(self, tmp_fn, digest):
+        """
+        Given a temporary file with the content for ``digest``, returns
+        a temporary file that is linked to the blob for that content:
+        either tmp_fn itself, newly made the blob, or a link to the
+        existing blob (and tmp_fn is removed).
+        """
+        blob_fn = self.blob_filename(digest)
+        ensure_parent(blob_fn)
+        while 1:
+            if os.stat(tmp_fn).st_nlink > 1:
+                # Already the blob (from link_blob)
+                return tmp_fn
+            try:
+                os.link(tmp_fn, blob_fn)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                return tmp_fn
+            link_fn = self.link_blob(digest, tmp_fn)
+            if link_fn is not None:
+                os.unlink(tmp_fn)
+                return link_fn
+            # The blob was just released; try again to make it
 
-    def get_media_content_type(self, slug):
-        fn = self.get_filename(slug, 'media') + '.content-type'
-        if not os.path.exists(fn):
-            return mimetypes.guess_type(slug)[0]
-        f = open(fn)
+    def release_blob(self, digest):
+        """
+        Removes the blob for ``digest`` if nothing links to it anymore.
+        """
+        blob_fn = self.blob_filename(digest)
         try:
-            return f.read().strip()
-        finally:
-            f.close()
+            if os.stat(blob_fn).st_nlink == 1:
+                os.unlink(blob_fn)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def media_info(self, slug):
+        """
+        Returns a dictionary of what is known about the media (see
+        `flatatompub.mediameta`).
+        """
+        return self.media_metadata.get(slug)
+
+    def set_media_entry(self, media_slug, entry_slug):
+        self.media_metadata.set(media_slug, entry_slug=entry_slug)
 
     def set_media_content_type(self, slug, content_type):
-        fn = self.get_filename(slug, 'media') + '.content-type'
-        f = open(fn, 'w')
-        f.write(content_type)
-        f.close()
+        self.media_metadata.set(slug, content_type=content_type)
 
     def delete_media(self, slug):
-        base = self.get_filename(slug, 'media')
-        for ext in ['.content-type', '.entry-slug', '']:
-            fn = base + ext
-            if os.path.exists(fn):
-                os.unlink(fn)
+        digest = self.get_media_digest(slug)
+        fn = self.get_filename(slug, 'media')
+        if os.path.exists(fn):
+            os.unlink(fn)
+        self.media_metadata.delete(slug)
+        if digest:
+            self.release_blob(digest)
 
     ############################################################
     ## Feeds
     ############################################################
 
     def entry_slugs(self):
-        filenames = [
-            fn for fn in os.listdir(self.data_dir)
-            if not os.path.isdir(os.path.join(self.data_dir, fn))]
-        filenames.sort(key=lambda fn:
-                       -os.path.getmtime(os.path.join(self.data_dir, fn)))
-        return filenames
+        files = []
+        for slug, fn in iter_files(self.data_dir, self.shard_depth):
+            st = os.stat(fn)
+            if st.st_size:
+                files.append((-st.st_mtime, slug))
+        files.sort()
+        return [slug for mtime, slug in files]
 
-    def most_recent(self):
-        most_recent = 0
-        for fn in os.listdir(self.data_dir):
-            fn = os.path.join(self.data_dir, fn)
-            if os.path.isdir(fn):
-                continue
-            most_recent = max(os.path.getmtime(fn), most_recent)
-        return datetime.fromtimestamp(most_recent, UTC)
+    def collection_state(self):
+        """
+        Returns ``(version, last_changed)``.  The version goes up
+        every time an entry is saved or deleted, and last_changed is
+        the (UTC) datetime of the last such change.
+
+        The index may keep this (see ``Index.collection_state``);
+        otherwise it is kept in a small file in the data directory.
+        """
+        state = self.index.collection_state(self)
+        if state is not None:
+            return state
+        fn = os.path.join(self.data_dir, '.collection')
+        try:
+            f = open(fn, 'rb')
+        except IOError:
+            # A store from before this was tracked
+            most_recent = 0
+            for slug, fn in iter_files(self.data_dir, self.shard_depth):
+                most_recent = max(os.path.getmtime(fn), most_recent)
+            version, last_changed = 0, most_recent
+            try:
+                fd = os.open(fn, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+            except OSError:
+                # Someone else just created it
+                pass
+            else:
+                os.write(fd, '%s %r' % (version, last_changed))
+                os.close(fd)
+        else:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                data = f.read().split()
+            finally:
+                f.close()
+            if len(data) == 2:
+                version, last_changed = int(data[0]), float(data[1])
+            else:
+                # Just being created
+                version, last_changed = 0, 0
+        return version, datetime.fromtimestamp(last_changed, UTC)
+
+    def collection_changed(self, version=None):
+        """
+        Bumps the collection version and last-changed time.  This is
+        safe to call from several processes at once.
+        """
+        fn = os.path.join(self.data_dir, '.collection')
+        fd = os.open(fn, os.O_RDWR|os.O_CREAT, 0666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if version is None:
+                data = os.read(fd, 100).split()
+                if data:
+                    version = int(data[0])
+                else:
+                    version = 0
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%s %r' % (version + 1, time.time()))
+        finally:
+            # This also releases the lock
+            os.close(fd)
+
+# Options the filesystem store takes from the configuration, and
+# how to convert them (bool means paste.deploy's asbool):
+store_options = dict(
+    media_dir=str,
+    shard_depth=int,
+    entry_cache_size=int,
+    entry_cache_bytes=int,
+    fragment_cache_bytes=int,
+    upload_chunk_size=int,
+    media_dedup=bool,
+    media_metadata=str,
+    )
+
+def convert_options(options, converters):
+    """
+    Converts configuration strings to the types given in
+    ``converters``, raising TypeError for unknown options.
+    """
+    from paste.deploy.converters import asbool
+    result = {}
+    for name, value in options.items():
+        if name not in converters:
+            raise TypeError(
+                "Unexpected store option: %s" % name)
+        convert = converters[name]
+        if convert is bool:
+            convert = asbool
+        result[name] = convert(value)
+    return result
+
+def make_store(global_conf, data_dir, index, **options):
+    """
+    Factory for the filesystem store
+    """
+    return Store(data_dir, index=index,
+                 **convert_options(options, store_options))
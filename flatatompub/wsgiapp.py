@@ -1,7 +1,7 @@
 import os
 from flatatompub import flatapp
-from flatatompub.store import Store
 from flatatompub.dec import bindery
+from flatatompub.responsecache import ResponseCache
 from taggerclient import atom
 import pkg_resources
 
@@ -19,9 +19,16 @@ def make_app(
     feed_info=None,
     feed_title=None,
     clean_html=False,
+    stream_feeds=False,
+    cursor_paging=False,
+    response_cache_size=100,
+    response_cache_bytes=16*1024*1024,
+    response_cache_dir=None,
     index='FlatAtomPub:simple',
+    store='FlatAtomPub:filesystem',
     **kwargs):
     index_factory = load_entry_point('flatatompub.index_factory', index)
+    store_factory = load_entry_point('flatatompub.store_factory', store)
     index_global_conf = global_conf.copy()
     index_global_conf.update(kwargs)
     index_global_conf.update(dict(
@@ -31,7 +38,9 @@ def make_app(
         page_limit=page_limit,
         feed_info=feed_info,
         feed_title=feed_title,
-        clean_html=clean_html))
+        clean_html=clean_html,
+        stream_feeds=stream_feeds,
+        cursor_paging=cursor_paging))
     index_options = {}
     for name, value in kwargs.items():
         if name.startswith('index'):
@@ -39,6 +48,13 @@ def make_app(
             name = name[len('index'):].strip()
             name = name.lstrip('_')
             index_options[name] = value
+    store_options = {}
+    for name, value in kwargs.items():
+        if name.startswith('store'):
+            del kwargs[name]
+            name = name[len('store'):].strip()
+            name = name.lstrip('_')
+            store_options[name] = value
     if kwargs:
         raise TypeError(
             "Unexpected configuration keys: %s"
@@ -47,7 +63,12 @@ def make_app(
     from paste.deploy.converters import asbool
     data_dir = os.path.normpath(data_dir)
     page_limit = int(page_limit)
-    store = Store(data_dir, index=index)
+    store = store_factory(index_global_conf, data_dir, index, **store_options)
+    response_cache_size = int(response_cache_size)
+    if response_cache_size or response_cache_dir:
+        store.response_cache = ResponseCache(
+            response_cache_size, int(response_cache_bytes),
+            response_cache_dir)
     if asbool(clear):
         print 'Clearing store at %s' % data_dir
         store.clear()
@@ -60,6 +81,8 @@ def make_app(
         feed_info=feed_info,
         feed_title=feed_title,
         clean_html=asbool(clean_html),
+        stream_feeds=asbool(stream_feeds),
+        cursor_paging=asbool(cursor_paging),
         )
     app = bindery(app, store=store, config=config)
     debug = asbool(debug)
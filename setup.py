@@ -35,8 +35,16 @@ setup(name='FlatAtomPub',
       [paste.app_factory]
       main = flatatompub.wsgiapp:make_app
 
+      [console_scripts]
+      flatatompub-migrate = flatatompub.migrate:main
+
       [flatatompub.index_factory]
       simple = flatatompub.naiveindex:make_index
       sqlite = flatatompub.sqliteindex:make_index
+      memory = flatatompub.memoryindex:make_index
+
+      [flatatompub.store_factory]
+      filesystem = flatatompub.store:make_store
+      pack = flatatompub.packstore:make_store
       """,
       )
@@ -0,0 +1,113 @@
+import os
+from webtest import TestApp
+from flatatompub.wsgiapp import make_app
+from taggerclient import atom
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-feed-data')
+
+def get_app(**kw):
+    return TestApp(make_app(
+        {}, data_dir=output_dir, clear=True, page_limit=2,
+        cursor_paging=True, **kw))
+
+def post_entry(app, id):
+    entry = atom.Element('entry', nsmap=atom.nsmap)
+    entry.id = id
+    entry.title = 'Entry %s' % id
+    app.post('/', atom.tostring(entry),
+             headers={'content-type': 'application/atom+xml;type=entry'},
+             status=201)
+
+def get_page(app, url):
+    feed = atom.ATOM(app.get(url).body)
+    links = {}
+    for rel in ['next', 'previous', 'first']:
+        for link in feed.rel_links(rel):
+            links[rel] = link.href
+    return [entry.id for entry in feed.entries], links
+
+def test_cursor_paging():
+    for index in ['FlatAtomPub:simple', 'FlatAtomPub:sqlite',
+                  'FlatAtomPub:memory']:
+        yield check_cursor_paging, index
+
+def check_cursor_paging(index):
+    app = get_app(index=index)
+    for i in range(5):
+        post_entry(app, 'test%s' % i)
+    ids, links = get_page(app, '/')
+    assert len(ids) == 2
+    assert 'previous' not in links
+    seen = list(ids)
+    second_url = links['next']
+    second, links = get_page(app, second_url)
+    seen.extend(second)
+    assert get_page(app, links['previous'])[0] == ids
+    while 'next' in links:
+        page, links = get_page(app, links['next'])
+        seen.extend(page)
+    seen.sort()
+    assert seen == ['test%s' % i for i in range(5)]
+    # New entries don't shift later pages:
+    post_entry(app, 'test5')
+    assert get_page(app, second_url)[0] == second
+    app.get('/?after=!', status=400)
+
+def test_max_results():
+    for cursor_paging in [True, False]:
+        yield check_max_results, cursor_paging
+
+def check_max_results(cursor_paging):
+    app = TestApp(make_app(
+        {}, data_dir=output_dir, clear=True, page_limit=2,
+        cursor_paging=cursor_paging))
+    for i in range(3):
+        post_entry(app, 'test%s' % i)
+    assert len(get_page(app, '/?max-results=1')[0]) == 1
+    app.get('/?max-results=0', status=400)
+    app.get('/?max-results=-1', status=400)
+
+def test_gdata_paging():
+    app = get_app(index='FlatAtomPub:sqlite')
+    for i in range(5):
+        post_entry(app, 'test%s' % i)
+    ids, links = get_page(app, '/-/?max-results=2')
+    seen = list(ids)
+    while 'next' in links:
+        page, links = get_page(app, links['next'])
+        assert len(page) <= 2
+        seen.extend(page)
+    assert seen == ['test%s' % i for i in range(5)]
+
+class FragmentIndex(object):
+    def __init__(self):
+        self.calls = []
+    def entry_fragments(self, slugs):
+        self.calls.append(slugs)
+        return dict([(slug, '<%s/>' % slug) for slug in slugs
+                     if slug not in ('from-store', 'deleted')])
+
+class FragmentStore(object):
+    def __init__(self):
+        self.index = FragmentIndex()
+    def entry_fragment(self, slug):
+        if slug == 'deleted':
+            raise KeyError(slug)
+        return '<store %s/>' % slug
+
+def test_entry_fragments():
+    from flatatompub.flatapp import entry_fragments
+    store = FragmentStore()
+    consumed = []
+    def slugs():
+        for slug in ['a', 'from-store', 'deleted', 'b', 'c']:
+            consumed.append(slug)
+            yield slug
+    fragments = entry_fragments(store, slugs(), chunk_size=2)
+    assert fragments.next() == '<a/>'
+    # Only the first chunk has been read:
+    assert consumed == ['a', 'from-store']
+    assert list(fragments) == ['<store from-store/>', '<b/>', '<c/>']
+    assert store.index.calls == [['a', 'from-store'], ['deleted', 'b'],
+                                 ['c']]
@@ -0,0 +1,51 @@
+import os
+from webtest import TestApp
+from flatatompub.fileserve import MediaApp, parse_range
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-data')
+
+def make_app():
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    fn = os.path.join(output_dir, 'media-test.txt')
+    f = open(fn, 'wb')
+    f.write('0123456789' * 10)
+    f.close()
+    return TestApp(MediaApp(fn, 'text/plain', 'abc'))
+
+def test_parse_range():
+    assert parse_range('bytes=0-9', 100) == [(0, 10)]
+    assert parse_range('bytes=90-', 100) == [(90, 100)]
+    assert parse_range('bytes=-5', 100) == [(95, 100)]
+    assert parse_range('bytes=95-200', 100) == [(95, 100)]
+    assert parse_range('bytes=0-4,2-9,20-29', 100) == [(0, 10), (20, 30)]
+    assert parse_range('bytes=200-300', 100) == []
+    assert parse_range('bytes=9-0', 100) is None
+    assert parse_range('lines=0-9', 100) is None
+
+def test_whole_file():
+    app = make_app()
+    res = app.get('/')
+    assert res.body == '0123456789' * 10
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    assert res.headers['ETag'] == '"abc"'
+    app.get('/', headers={'If-None-Match': '"abc"'}, status=304)
+
+def test_ranges():
+    app = make_app()
+    res = app.get('/', headers={'Range': 'bytes=10-14'}, status=206)
+    assert res.body == '01234'
+    assert res.headers['Content-Range'] == 'bytes 10-14/100'
+    res = app.get('/', headers={'Range': 'bytes=0-1,-2'}, status=206)
+    assert res.headers['Content-Type'].startswith('multipart/byteranges')
+    assert 'Content-Range: bytes 0-1/100\r\n\r\n01\r\n' in res.body
+    assert 'Content-Range: bytes 98-99/100\r\n\r\n89\r\n' in res.body
+    assert len(res.body) == int(res.headers['Content-Length'])
+    app.get('/', headers={'Range': 'bytes=500-'}, status=416)
+    # A stale If-Range gets the whole file:
+    res = app.get('/', headers={'Range': 'bytes=10-14',
+                                'If-Range': '"old"'}, status=200)
+    assert len(res.body) == 100
+    res = app.get('/', headers={'Range': 'bytes=10-14',
+                                'If-Range': '"abc"'}, status=206)
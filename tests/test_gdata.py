@@ -9,12 +9,12 @@ here = os.path.dirname(__file__)
 gdata_dir = os.path.join(here, 'gdata-test-data')
 output_dir = os.path.join(here, 'unittest-data')
 
-def get_app():
+def get_app(**kw):
     return TestApp(make_app(
         {}, data_dir=output_dir,
         index='FlatAtomPub:sqlite',
         index_table_prefix='foo_',
-        clear=True))
+        clear=True, **kw))
 
 def test_gdata():
     if not os.path.exists(output_dir):
@@ -22,6 +22,8 @@ def test_gdata():
     for fn in os.listdir(gdata_dir):
         if fn.endswith('.testcase'):
             yield run_case, fn
+            yield run_case, fn, True
+            yield run_case, fn, False, True
 
 def read_file(fn):
     f = open(fn, 'rb')
@@ -30,9 +32,11 @@ def read_file(fn):
     finally:
         f.close()
 
-def run_case(fn):
+def run_case(fn, stream_feeds=False, entry_bodies=False):
     fn = os.path.join(gdata_dir, fn)
-    app = get_app()
+    app = get_app(stream_feeds=stream_feeds,
+                  index_entry_bodies=entry_bodies,
+                  index_compress_bodies=entry_bodies)
     last_results = None
     last_query = None
     found = None
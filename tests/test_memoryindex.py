@@ -0,0 +1,95 @@
+import os
+import shutil
+from webob import Request
+from taggerclient import gdata
+from flatatompub.memoryindex import MemoryIndex
+from flatatompub.store import Store
+from test_gdata import gdata_dir
+from test_sqliteindex import check_corpus, check_query_order
+from test_store import make_entry
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-memory-data')
+
+def test_corpus():
+    for fn in os.listdir(gdata_dir):
+        if fn.endswith('.testcase'):
+            yield check_corpus, fn, MemoryIndex
+
+def test_query_order():
+    check_query_order(MemoryIndex())
+
+def add_entry(store, id, **attrs):
+    atom_entry = make_entry(id)
+    for name, value in attrs.items():
+        setattr(atom_entry, name, value)
+    entry = store.EntryClass(store, suggest_slug=id, atom_entry=atom_entry)
+    entry.save()
+    return entry.slug
+
+def query(index, store, path):
+    req = Request.blank('/-/%s' % path)
+    return index.gdata_query(gdata.parse_gdata(req), store)[1]
+
+def test_snapshot():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    snapshot = os.path.join(output_dir, 'db', 'index.pickle')
+    index = MemoryIndex(snapshot=snapshot)
+    store = Store(output_dir, index=index)
+    a = add_entry(store, 'a', title='apples')
+    b = add_entry(store, 'b', title='bananas')
+    assert query(index, store, '?q=apple') == [a]
+    assert [slug for key, slug in index.most_recent_page(store, 1)] == [b]
+    index.save_snapshot()
+    assert os.path.exists(snapshot)
+    # Changed behind the index's back (like by another process):
+    other = Store(output_dir, index=MemoryIndex())
+    entry = other.get_entry(a)
+    entry.atom_entry.title = 'cherries'
+    entry.save()
+    other.get_entry(b).delete()
+    c = add_entry(other, 'c', title='more apples')
+    # A new index starts from the snapshot and reads only the
+    # changes; the old one notices them too:
+    for index in [MemoryIndex(snapshot=snapshot), index]:
+        store = Store(output_dir, index=index)
+        assert query(index, store, '?q=apple') == [c]
+        assert query(index, store, '?q=cherries') == [a]
+        assert query(index, store, '?q=bananas') == []
+        total, slugs = index.most_recent(store, 0, None)
+        assert total == 2
+        assert sorted(slugs) == sorted([a, c])
+
+def test_text_query():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    index = MemoryIndex()
+    store = Store(output_dir, index=index)
+    a = add_entry(store, 'a', title='green apples and bananas')
+    b = add_entry(store, 'b', title='applesauce')
+    for i in range(2):
+        assert sorted(query(index, store, '?q=pple')) == sorted([a, b])
+        assert query(index, store, '?q=apples+and') == [a]
+        assert query(index, store, '?q=les+and+ban') == [a]
+        assert query(index, store, '?q=een+apples') == [a]
+        assert query(index, store, '?q=sauce') == [b]
+        assert query(index, store, '?q=apples+sauce') == []
+        # The same, once new words are merged into the sorted lists:
+        index.words.merge()
+
+def test_word_index():
+    from flatatompub.memoryindex import WordIndex
+    words = WordIndex()
+    words.merge_threshold = 2
+    for token, slug in [(u'apples', 'a'), (u'applesauce', 'b'),
+                        (u'grapes', 'c'), (u'apples', 'c')]:
+        words.add(token, slug)
+    words.remove(u'grapes', 'c')
+    for i in range(2):
+        assert words.find(u'apples', True, True) == set(['a', 'c'])
+        assert words.find(u'apples', start=True) == set(['a', 'b', 'c'])
+        assert words.find(u'sauce', end=True) == set(['b'])
+        assert words.find(u'pes', end=True) == set()
+        assert words.find(u'ple') == set(['a', 'b', 'c'])
+        words.merge()
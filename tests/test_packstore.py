@@ -0,0 +1,96 @@
+import os
+import shutil
+from flatatompub.packstore import PackStore
+from flatatompub import packstore
+from flatatompub import naiveindex
+from taggerclient import atom
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-pack-data')
+
+def make_store(**kw):
+    return PackStore(output_dir, index=naiveindex.Index(),
+                     segment_size=1000, **kw)
+
+def add_entry(store, id):
+    atom_entry = atom.Element('entry', nsmap=atom.nsmap)
+    atom_entry.id = id
+    entry = store.EntryClass(store, atom_entry=atom_entry)
+    entry.save()
+    return entry.slug
+
+def test_pack_store():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    store = make_store()
+    slugs = [add_entry(store, 'test%s' % i) for i in range(20)]
+    assert len(store.segments()) > 1
+    assert sorted(store.entry_slugs()) == sorted(slugs)
+    assert store.get_entry(slugs[0]).atom_entry.id == 'test0'
+    fp, info = store.open_entry(slugs[0])
+    assert info.etag == store.etag(slugs[0], 'entry')
+    assert fp.read() == str(store.get_entry(slugs[0]))
+    store.get_entry(slugs[1]).delete()
+    # Another process sees the same entries:
+    other = make_store()
+    assert sorted(other.entry_slugs()) == sorted(slugs[:1] + slugs[2:])
+    # ...and later changes:
+    new_slug = add_entry(store, 'new')
+    assert other.get_entry(new_slug).atom_entry.id == 'new'
+    store.compact()
+    assert store.garbage_ratio() == 0.0
+    assert other.get_entry(slugs[0]).atom_entry.id == 'test0'
+    try:
+        other.get_entry(slugs[1])
+    except KeyError:
+        pass
+    else:
+        assert 0, "KeyError expected"
+
+def test_generation():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    store = make_store(refresh_interval=60)
+    other = make_store(refresh_interval=60)
+    add_entry(store, 'test')
+    store.compact()
+    generation = store.read_generation()
+    # other hasn't seen the compaction, but mustn't reuse its number:
+    assert other.generation < generation
+    other.clear()
+    assert other.read_generation() == generation + 1
+    assert store.entry_slugs() == []
+
+def test_recovery():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    store = make_store()
+    slug = add_entry(store, 'test')
+    # A write that was cut off:
+    f = open(store.segment_filename(store.segments()[-1]), 'ab')
+    f.write('P cutoff 500 0 - 1.0\n<entry')
+    f.close()
+    store = make_store()
+    assert store.entry_slugs() == [slug]
+    new_slug = add_entry(store, 'new')
+    store = make_store()
+    assert sorted(store.entry_slugs()) == sorted([slug, new_slug])
+
+def test_store_factory():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    store = packstore.make_store(
+        {}, output_dir, naiveindex.Index(), segment_size='1000',
+        fsync='false', media_dedup='true', shard_depth='2')
+    assert isinstance(store, PackStore)
+    assert store.segment_size == 1000
+    assert not store.fsync
+    assert store.media_dedup is True
+    assert store.shard_depth == 2
+    try:
+        packstore.make_store({}, output_dir, naiveindex.Index(),
+                             no_such_option='1')
+    except TypeError:
+        pass
+    else:
+        assert 0, "Unknown option accepted"
@@ -0,0 +1,43 @@
+import os
+import shutil
+from webob import Request
+from flatatompub.responsecache import ResponseCache
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-cache-data')
+
+def make_cache(**kw):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    return ResponseCache(**kw)
+
+def test_make_key():
+    cache = make_cache()
+    key1 = cache.make_key(Request.blank('/-/a?max-results=2&start-index=3'))
+    key2 = cache.make_key(Request.blank('/-/a?start-index=3&max-results=2'))
+    assert key1 == key2
+    assert key1 != cache.make_key(Request.blank('/-/a?start-index=3'))
+
+def test_memory():
+    cache = make_cache(max_items=2)
+    cache.set(1, 'feed', '<feed/>', 'abc')
+    assert cache.get(1, 'feed') == ('<feed/>', 'abc')
+    # Rendered at another version:
+    assert cache.get(2, 'feed') is None
+    cache.invalidate()
+    assert cache.get(1, 'feed') is None
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+
+def test_disk():
+    cache = make_cache(cache_dir=output_dir)
+    other = ResponseCache(cache_dir=output_dir)
+    cache.set(1, 'feed', '<feed>\n</feed>', 'abc')
+    assert other.get(1, 'feed') == ('<feed>\n</feed>', 'abc')
+    assert other.stats()['disk_hits'] == 1
+    other.invalidate()
+    assert os.listdir(output_dir) == []
+    cache.memory.clear()
+    assert cache.get(1, 'feed') is None
+    assert cache.stats()['disk_misses'] == 1
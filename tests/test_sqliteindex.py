@@ -0,0 +1,326 @@
+"""
+Checks that the SQL the SQLite index compiles GData queries to finds
+exactly the entries that ``evaluate()`` would.
+"""
+import os
+import shutil
+import threading
+from datetime import datetime
+from webob import Request
+from taggerclient import gdata
+from pysqlite2.dbapi2 import connect, OperationalError
+from flatatompub.sqliteindex import SQLiteIndex, make_index
+from flatatompub.sqlitepool import PoolTimeout
+from flatatompub.store import make_fragment
+from taggerclient.atom import tostring
+from test_gdata import make_entry, read_file, gdata_dir
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-sqlite-data')
+
+# Queries beyond those in the test cases:
+extra_queries = [
+    '?q=100%',
+    '?q=under_score',
+    '?q=*',
+    '?q=[',
+    '?updated-min=2008-01-01T00:00:00Z',
+    '?updated-max=2008-01-01T00:00:00Z',
+    '?published-min=2008-01-01T00:00:00Z&published-max=2008-06-01T00:00:00Z',
+    'term1/-term2?author=bob',
+    ]
+
+def test_corpus():
+    for fn in os.listdir(gdata_dir):
+        if fn.endswith('.testcase'):
+            yield check_corpus, fn
+
+def check_corpus(fn, new_index=None):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    if new_index is None:
+        index = SQLiteIndex(os.path.join(output_dir, 'db.sqlite'))
+    else:
+        index = new_index()
+    entries = {}
+    queries = list(extra_queries)
+    for line in read_file(os.path.join(gdata_dir, fn)).splitlines():
+        parts = line.strip().split(None, 1)
+        if len(parts) < 2:
+            continue
+        if parts[0] == 'post':
+            entry = make_entry(parts[1])
+            n = len(entries)
+            # Spread the dates out, for the date range queries:
+            if entry.updated is None:
+                entry.updated = datetime(2007 + n % 2, n % 12 + 1, 1)
+            entry.published = datetime(2007 + n % 2, n % 12 + 1, 1)
+            slug = 'slug-%s' % n
+            entries[slug] = entry
+            index.entry_added(slug, entry)
+        elif parts[0] == 'get':
+            queries.append(parts[1])
+    for query in queries:
+        req = Request.blank('/-/%s' % query)
+        rest, slugs = index.gdata_query(gdata.parse_gdata(req), None)
+        assert rest is None
+        expected = [slug for slug, entry in entries.items()
+                    if gdata.parse_gdata(req).evaluate(entry)]
+        slugs.sort()
+        expected.sort()
+        assert slugs == expected, (
+            "%s: the index gives %s, evaluate() gives %s"
+            % (query, slugs, expected))
+
+def test_fulltext():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    try:
+        index = SQLiteIndex(os.path.join(output_dir, 'db.sqlite'),
+                            table_prefix='fts_', fulltext=True)
+    except Exception, e:
+        from nose import SkipTest
+        raise SkipTest("No FTS5: %s" % e)
+    contents = [
+        ('harry', 'harry potter again'),
+        ('more', 'potter and potter'),
+        ('arthur', 'Arthur Weasley'),
+        ('gone', 'potter'),
+        ]
+    for slug, content in contents:
+        index.entry_added(slug, make_entry('%s content=%s' % (
+            slug, content.replace(' ', '+'))))
+    index.entry_deleted('gone', None)
+    index.entry_updated('harry', make_entry('harry content=harry+potter+again'))
+    def query(q):
+        req = Request.blank('/-/?q=%s' % q)
+        return index.gdata_query(gdata.parse_gdata(req), None)[1]
+    assert sorted(query('potter')) == ['harry', 'more']
+    # More mentions rank first:
+    assert query('potter') == ['more', 'harry']
+    assert query('arthur') == ['arthur']
+    assert query('%22harry+potter%22') == ['harry']
+    assert query('%22potter+harry%22') == []
+    assert query('pot*') == ['more', 'harry']
+    assert query('potter+-harry') == ['more']
+    assert query('-potter') == ['arthur']
+    index.clear()
+    assert query('potter') == []
+
+def test_fulltext_turned_off():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    db_filename = os.path.join(output_dir, 'db.sqlite')
+    try:
+        index = SQLiteIndex(db_filename, table_prefix='fts_', fulltext=True)
+    except Exception, e:
+        from nose import SkipTest
+        raise SkipTest("No FTS5: %s" % e)
+    index.entry_added('harry', make_entry('harry content=harry+potter'))
+    index.entry_added('gone', make_entry('gone content=potter'))
+    # Changes made while fulltext is off...
+    index = SQLiteIndex(db_filename, table_prefix='fts_')
+    index.entry_updated('harry', make_entry('harry content=harry+weasley'))
+    index.entry_deleted('gone', None)
+    index.entry_added('gone', make_entry('gone content=arthur'))
+    # ...are searched once it is back on:
+    index = SQLiteIndex(db_filename, table_prefix='fts_', fulltext=True)
+    def query(q):
+        req = Request.blank('/-/?q=%s' % q)
+        return index.gdata_query(gdata.parse_gdata(req), None)[1]
+    assert query('potter') == []
+    assert query('weasley') == ['harry']
+    assert query('arthur') == ['gone']
+
+def test_migrate():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    db_filename = os.path.join(output_dir, 'old.sqlite')
+    os.makedirs(output_dir)
+    # A database from before schema versions:
+    conn = connect(db_filename)
+    for table_name, sql in SQLiteIndex.create_table_statements:
+        conn.execute(sql % dict(table_prefix='old_'))
+    conn.execute("INSERT INTO old_entries (slug, id) VALUES ('2008', 'a')")
+    conn.execute("INSERT INTO old_entries (slug, id) VALUES ('b', 'b')")
+    conn.execute("INSERT INTO old_categories (entry_slug, term) "
+                 "VALUES ('2008', '10')")
+    conn.commit()
+    conn.close()
+    index = SQLiteIndex(db_filename, table_prefix='old_')
+    assert index.schema_version() == index.migrations[-1][0]
+    cur = index.execute("SELECT slug, typeof(slug) FROM old_entries "
+                        "ORDER BY rowid")
+    assert cur.fetchall() == [('2008', 'text'), ('b', 'text')]
+    cur = index.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                        "AND tbl_name = 'old_categories'")
+    names = [row[0] for row in cur.fetchall()]
+    assert 'old_categories_term' in names
+    req = Request.blank('/-/10')
+    assert index.gdata_query(gdata.parse_gdata(req), None)[1] == ['2008']
+    # Nothing more to do the second time:
+    index.migrate()
+    assert index.schema_version() == index.migrations[-1][0]
+
+def test_migrate_dates():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    db_filename = os.path.join(output_dir, 'dates.sqlite')
+    entry = make_entry('a updated=2008-01-01T12:00:00%2B02:00')
+    index = SQLiteIndex(db_filename)
+    index.entry_added('a', entry)
+    # As stored before dates were converted to UTC:
+    index.execute("UPDATE entries SET updated = '2008-01-01T12:00:00'")
+    index.execute("UPDATE schema_version SET version = 3")
+    # (Migration 2 can be run again, if it was partly done)
+    for sql in dict(index.migrations)[2]:
+        index.execute(sql % dict(table_prefix=''))
+    class Store(object):
+        def load_entry(self, slug):
+            return entry
+    index = SQLiteIndex(db_filename)
+    assert index.schema_version() == index.migrations[-1][0]
+    def updated():
+        cur = index.execute("SELECT updated FROM entries")
+        return cur.fetchone()[0]
+    assert updated() == '2008-01-01T12:00:00'
+    index.most_recent(Store(), 0, 10)
+    assert updated() == '2008-01-01T10:00:00'
+    cur = index.execute("SELECT COUNT(*) FROM date_fixes")
+    assert cur.fetchone()[0] == 0
+
+def test_update_entry():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    index = SQLiteIndex(os.path.join(output_dir, 'db.sqlite'))
+    index.entry_added('a', make_entry(
+        'a category=term1 category=term2 link=target:http://example.com/1'))
+    index.entry_added('b', make_entry('b category=term1'))
+    def rowids(table):
+        cur = index.execute("SELECT rowid, term FROM %s WHERE entry_slug = 'a' "
+                            "ORDER BY term" % table)
+        return cur.fetchall()
+    before = rowids('categories')
+    index.entry_updated('a', make_entry(
+        'a category=term2 category=term3 link=target:http://example.com/2'))
+    after = rowids('categories')
+    # term2 was left alone:
+    assert before[1] == after[0]
+    assert [term for rowid, term in after] == ['term2', 'term3']
+    def query(path):
+        req = Request.blank('/-/%s' % path)
+        return index.gdata_query(gdata.parse_gdata(req), None)[1]
+    assert query('term1') == ['b']
+    assert query('?rel-target=http://example.com/2') == ['a']
+    assert query('?rel-target=http://example.com/1') == []
+    index.entry_deleted('a', None)
+    assert query('term2') == []
+
+def test_query_order():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    check_query_order(SQLiteIndex(os.path.join(output_dir, 'db.sqlite')))
+
+def check_query_order(index):
+    # Results are ordered by edited time, then slug; an edited entry
+    # moves to the end:
+    def add(data, edited):
+        entry = make_entry(data)
+        entry.edited = edited
+        return entry
+    index.entry_added('b', add('b category=term1',
+                               datetime(2008, 1, 1)))
+    index.entry_added('a', add('a category=term1',
+                               datetime(2008, 1, 1)))
+    index.entry_added('c', add('c category=term1',
+                               datetime(2008, 1, 2)))
+    def query(path):
+        req = Request.blank('/-/%s' % path)
+        return index.gdata_query(gdata.parse_gdata(req), None)[1]
+    assert query('term1') == ['a', 'b', 'c']
+    index.entry_updated('a', add('a category=term1',
+                                 datetime(2008, 1, 3)))
+    assert query('term1') == ['b', 'c', 'a']
+
+def test_pool():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    index = make_index({}, db=os.path.join(output_dir, 'pool.sqlite'),
+                       pool_size='2', cache_size='-4000',
+                       synchronous='normal')
+    pool = index.pool
+    cur = index.execute("SELECT * FROM pragma_journal_mode")
+    assert cur.fetchall() == [('wal',)]
+    cur = index.execute("SELECT * FROM pragma_cache_size")
+    assert cur.fetchall() == [(-4000,)]
+    reader = pool.acquire(readonly=True)
+    try:
+        try:
+            reader.execute("DELETE FROM entries")
+        except OperationalError:
+            pass
+        else:
+            assert 0, "Reader connections should be read-only"
+    finally:
+        pool.release(reader, readonly=True)
+    # Entries written in other threads are all seen:
+    def add(slug):
+        index.entry_added(slug, make_entry(slug))
+    threads = [threading.Thread(target=add, args=('entry%s' % i,))
+               for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cur = index.execute("SELECT COUNT(*) FROM entries")
+    assert cur.fetchall() == [(10,)]
+    stats = pool.stats()
+    assert stats['writers'] == 1
+    assert stats['readers'] <= 2
+    # Idle connections are closed:
+    pool.idle_timeout = 0
+    index.execute("SELECT COUNT(*) FROM entries")
+    pool.lock.acquire()
+    try:
+        pool.close_idle()
+    finally:
+        pool.lock.release()
+    assert pool.stats() == dict(readers=0, idle_readers=0,
+                                writers=0, idle_writers=0)
+    # When all connections are in use, you have to wait:
+    pool.max_readers = 1
+    pool.wait_timeout = 0.1
+    reader = pool.acquire(readonly=True)
+    try:
+        try:
+            pool.acquire(readonly=True)
+        except PoolTimeout:
+            pass
+        else:
+            assert 0, "Should have timed out"
+    finally:
+        pool.release(reader, readonly=True)
+    pool.close()
+
+def test_entry_bodies():
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    for compress in False, True:
+        index = SQLiteIndex(
+            os.path.join(output_dir, 'bodies-%s.sqlite' % compress),
+            entry_bodies=True, compress_bodies=compress)
+        a = make_entry('a category=term1')
+        index.entry_added('a', a)
+        index.entry_added('b', make_entry('b'))
+        fragments = index.entry_fragments(['a', 'b', 'missing'])
+        assert sorted(fragments.keys()) == ['a', 'b']
+        assert fragments['a'] == make_fragment(tostring(a))
+        assert not fragments['a'].startswith('<?xml')
+        a = make_entry('a category=term2')
+        index.entry_updated('a', a)
+        assert index.entry_fragments(['a'])['a'] == make_fragment(tostring(a))
+        index.entry_deleted('a', None)
+        assert index.entry_fragments(['a']) == {}
+    index = SQLiteIndex(os.path.join(output_dir, 'nobodies.sqlite'))
+    index.entry_added('a', make_entry('a'))
+    assert index.entry_fragments(['a']) is None
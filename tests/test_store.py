@@ -0,0 +1,422 @@
+import os
+import md5
+import shutil
+from flatatompub.store import Store, make_fragment
+from flatatompub import naiveindex
+from taggerclient import atom
+
+here = os.path.dirname(__file__)
+output_dir = os.path.join(here, 'unittest-store-data')
+
+def make_store(**kw):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    return Store(output_dir, index=naiveindex.Index(), **kw)
+
+def make_entry(id):
+    entry = atom.Element('entry', nsmap=atom.nsmap)
+    entry.id = id
+    entry.title = 'Entry %s' % id
+    return entry
+
+def add_entry(store, id):
+    entry = store.EntryClass(store, suggest_slug=id,
+                             atom_entry=make_entry(id))
+    entry.save()
+    return entry.slug
+
+def test_sharded_layout():
+    store = make_store(shard_depth=2)
+    slug = add_entry(store, 'test1')
+    fn = store.get_filename(slug, 'entry')
+    assert os.path.exists(fn)
+    assert os.path.dirname(os.path.dirname(os.path.dirname(fn))) == output_dir
+    assert store.entry_slugs() == [slug]
+    assert store.get_entry(slug).atom_entry.id == 'test1'
+    store.clear()
+    assert store.entry_slugs() == []
+
+def test_migrate_layout():
+    store = make_store()
+    slugs = [add_entry(store, 'test%s' % i) for i in range(5)]
+    media = store.MediaClass(store, suggest_slug='image')
+    media.create('image/png')
+    media.entry = slugs[0]
+    store = Store(output_dir, index=naiveindex.Index(), shard_depth=1)
+    # Files are found before the migration...
+    assert sorted(store.entry_slugs()) == sorted(slugs)
+    assert store.get_media(media.slug).content_type == 'image/png'
+    # (each entry has an .etag file)
+    assert store.migrate_layout('entry') == 10
+    assert store.migrate_layout('media') == 3
+    # ...and after:
+    assert sorted(store.entry_slugs()) == sorted(slugs)
+    for slug in slugs:
+        assert not os.path.exists(os.path.join(output_dir, slug))
+        assert store.get_entry(slug).atom_entry.id
+    media = store.get_media(media.slug)
+    assert media.content_type == 'image/png'
+    assert media.entry.slug == slugs[0]
+    assert store.migrate_layout('entry') == 0
+
+def test_shard_lookalike_dirs():
+    from flatatompub.store import detect_shard_depth
+    # db/ (where the index is kept by default) has a shard-like name:
+    def make_db_dir():
+        db_dir = os.path.join(output_dir, 'db')
+        if not os.path.exists(db_dir):
+            os.mkdir(db_dir)
+        for name in ['db.sqlite', 'memoryindex.pickle']:
+            f = open(os.path.join(db_dir, name), 'wb')
+            f.write('data')
+            f.close()
+        return [os.path.join(db_dir, name)
+                for name in ['db.sqlite', 'memoryindex.pickle']]
+    store = make_store()
+    db_files = make_db_dir()
+    slug = add_entry(store, 'test1')
+    assert store.entry_slugs() == [slug]
+    assert detect_shard_depth(output_dir) == 0
+    store = Store(output_dir, index=naiveindex.Index(), shard_depth=2)
+    assert store.migrate_layout('entry') == 2
+    assert store.entry_slugs() == [slug]
+    assert detect_shard_depth(output_dir) == 2
+    for fn in db_files:
+        assert os.path.exists(fn)
+    store.clear()
+    assert store.entry_slugs() == []
+    for fn in db_files:
+        assert os.path.exists(fn)
+    store = Store(output_dir, index=naiveindex.Index())
+    store.clear()
+    for fn in db_files:
+        assert os.path.exists(fn)
+
+def test_entry_cache():
+    store = make_store(entry_cache_size=2)
+    slugs = [add_entry(store, 'test%s' % i) for i in range(3)]
+    entry = store.load_entry(slugs[0])
+    assert store.entry_cache.stats()['misses'] == 1
+    # Copies are returned, so changes don't affect the cache:
+    entry.title = 'Changed'
+    assert store.load_entry(slugs[0]).title == 'Entry test0'
+    assert store.entry_cache.stats()['hits'] == 1
+    store.load_entry(slugs[1])
+    store.load_entry(slugs[2])
+    stats = store.entry_cache.stats()
+    assert stats['items'] == 2
+    assert stats['evictions'] == 1
+    # Saving invalidates the cached entry:
+    stored = store.get_entry(slugs[2])
+    stored.atom_entry.title = 'Updated'
+    stored.save()
+    assert store.load_entry(slugs[2]).title == 'Updated'
+
+def test_entry_cache_other_process():
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    fn = store.get_filename(slug, 'entry')
+    st = os.stat(fn)
+    assert store.load_entry(slug).title == 'Entry test1'
+    assert 'Entry test1' in store.entry_fragment(slug)
+    # A same-size save by another process, in the same mtime tick:
+    other = Store(output_dir, index=naiveindex.Index())
+    entry = other.get_entry(slug)
+    entry.atom_entry.title = 'Entry test2'
+    entry.save()
+    os.utime(fn, (st.st_atime, st.st_mtime))
+    assert os.path.getsize(fn) == st.st_size
+    assert store.load_entry(slug).title == 'Entry test2'
+    assert 'Entry test2' in store.entry_fragment(slug)
+    store.clear()
+    assert store.fragment_cache.stats()['items'] == 0
+
+def test_etag():
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    etag = store.etag(slug, 'entry')
+    assert os.path.exists(store.get_filename(slug, 'entry', '.etag'))
+    # Stable across store instances (processes):
+    store2 = Store(output_dir, index=naiveindex.Index())
+    assert store2.etag(slug, 'entry') == etag
+    entry = store.get_entry(slug)
+    entry.atom_entry.title = 'Updated'
+    entry.save()
+    assert store.etag(slug, 'entry') != etag
+    # Files from before ETags were stored:
+    os.unlink(store.get_filename(slug, 'entry', '.etag'))
+    assert store.etag(slug, 'entry') == entry.etag
+    entry.delete()
+    assert not os.path.exists(store.get_filename(slug, 'entry', '.etag'))
+
+def test_collection_state():
+    store = make_store()
+    version, last_changed = store.collection_state()
+    slug = add_entry(store, 'test1')
+    new_version, new_last_changed = store.collection_state()
+    assert new_version == version + 1
+    assert new_last_changed >= last_changed
+    assert store.most_recent() == new_last_changed
+    store.get_entry(slug).delete()
+    assert store.collection_state()[0] == version + 2
+    store.clear()
+    assert store.collection_state()[0] == version + 3
+
+def test_open_entry():
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    fp, info = store.open_entry(slug)
+    try:
+        body = fp.read()
+    finally:
+        fp.close()
+    assert body == str(store.get_entry(slug))
+    assert info.size == len(body)
+    assert info.etag == store.etag(slug, 'entry')
+    assert info.last_modified == store.last_modified(slug, 'entry')
+    try:
+        store.open_entry('nothere')
+    except KeyError:
+        pass
+    else:
+        assert 0, "KeyError expected"
+
+def test_write_media():
+    from StringIO import StringIO
+    store = make_store(upload_chunk_size=3)
+    media = store.MediaClass(store, suggest_slug='data')
+    media.create('application/octet-stream')
+    media.copy_file(StringIO('0123456789'), 10)
+    assert media.file.read() == '0123456789'
+    etag = media.etag
+    # No Content-Length:
+    media.copy_file(StringIO('abcdef'))
+    assert media.file.read() == 'abcdef'
+    assert media.etag != etag
+    # A short upload leaves the old content alone:
+    try:
+        media.copy_file(StringIO('xyz'), 10)
+    except ValueError:
+        pass
+    else:
+        assert 0, "ValueError expected"
+    assert media.file.read() == 'abcdef'
+    assert [name for name in os.listdir(store.media_dir)
+            if name.startswith('.tmp')] == []
+
+def test_media_dedup():
+    from StringIO import StringIO
+    import hashlib
+    store = make_store(media_dedup=True)
+    media = []
+    for i in range(2):
+        m = store.MediaClass(store, suggest_slug='image%s' % i)
+        m.create('image/png')
+        m.copy_file(StringIO('same content'), 12)
+        media.append(m)
+    digest = hashlib.sha256('same content').hexdigest()
+    blob_fn = store.blob_filename(digest)
+    assert os.stat(blob_fn).st_nlink == 3
+    assert media[0].etag == media[1].etag
+    # Known content with its digest is just linked:
+    linked = store.MediaClass(store, suggest_slug='image2')
+    linked.create('image/png')
+    linked.copy_file(StringIO('same content'), 12, digest)
+    assert os.stat(blob_fn).st_nlink == 4
+    # Each media item keeps its own modification time:
+    os.utime(blob_fn, (0, 0))
+    for m in media + [linked]:
+        assert m.last_modified.year > 1970
+    os.utime(linked.filename, (0, 0))
+    assert media[0].last_modified.year > 1970
+    try:
+        linked.copy_file(StringIO('other content'), 13, digest)
+    except ValueError:
+        pass
+    else:
+        assert 0, "ValueError expected"
+    assert linked.file.read() == 'same content'
+    for m in media:
+        m.delete(delete_entry=False)
+    assert os.stat(blob_fn).st_nlink == 2
+    linked.copy_file(StringIO('other content'), 13)
+    assert not os.path.exists(blob_fn)
+
+def test_sqlite_media_metadata():
+    from StringIO import StringIO
+    from flatatompub.mediameta import import_media
+    store = make_store()
+    media = store.MediaClass(store, suggest_slug='image')
+    media.create('image/png')
+    media.copy_file(StringIO('content'), 7)
+    media.entry = 'entry-slug'
+    etag = media.etag
+    store = Store(output_dir, index=naiveindex.Index(),
+                  media_metadata='sqlite')
+    # Not yet imported, but still found:
+    media = store.get_media(media.slug)
+    assert media.content_type == 'image/png'
+    assert import_media(store) == ([media.slug], [])
+    assert [name for name in os.listdir(store.media_dir)
+            if not name.startswith('.')] == [media.slug]
+    info = store.media_info(media.slug)
+    assert info['entry_slug'] == 'entry-slug'
+    assert info['content_type'] == 'image/png'
+    assert info['etag'] == etag
+    assert info['size'] == 7
+    media.delete(delete_entry=False)
+    assert store.media_info(media.slug) == {}
+
+def test_import_sharded_media():
+    from StringIO import StringIO
+    from flatatompub.mediameta import import_media
+    from flatatompub.store import detect_shard_depth
+    store = make_store(shard_depth=2)
+    media = store.MediaClass(store, suggest_slug='image')
+    media.create('image/png')
+    media.copy_file(StringIO('content'), 7)
+    bare = store.MediaClass(store, suggest_slug='bare')
+    bare.create('image/png')
+    os.unlink(store.get_filename(bare.slug, 'media', '.content-type'))
+    assert detect_shard_depth(store.media_dir) == 2
+    # Opened with the wrong shard_depth, the sidecars are still found:
+    store = Store(output_dir, index=naiveindex.Index(),
+                  media_metadata='sqlite')
+    assert import_media(store) == ([media.slug], [bare.slug])
+    assert store.media_info(media.slug)['content_type'] == 'image/png'
+    assert 'size' not in store.media_info(bare.slug)
+
+def test_clear_sqlite_media_metadata():
+    import threading
+    store = make_store(media_metadata='sqlite')
+    media = store.MediaClass(store, suggest_slug='image')
+    media.create('image/png')
+    store.clear()
+    assert store.media_info(media.slug) == {}
+    # A new connection (in another thread) finds the table:
+    results = []
+    def use_metadata():
+        store.media_metadata.set('other.png', content_type='image/png')
+        results.append(store.media_info('other.png'))
+    thread = threading.Thread(target=use_metadata)
+    thread.start()
+    thread.join()
+    assert results == [{'content_type': 'image/png'}]
+
+def test_create_slug():
+    store = make_store()
+    first = store.create_slug(None, 'entry', '')
+    second = store.create_slug(None, 'entry', '')
+    assert first != second
+    assert int(second.rsplit('-', 1)[1]) == int(first.rsplit('-', 1)[1]) + 1
+    # Another process sharing the store continues the sequence:
+    store2 = Store(output_dir, index=naiveindex.Index())
+    third = store2.create_slug(None, 'entry', '')
+    assert int(third.rsplit('-', 1)[1]) == int(first.rsplit('-', 1)[1]) + 2
+    assert store.create_slug('A title', 'entry', '') == 'Atitle'
+    assert store.create_slug('A title', 'entry', '') != 'Atitle'
+    # Reserved slugs aren't entries until they are saved:
+    assert store.entry_slugs() == []
+    store.release_slug('Atitle', 'entry')
+    assert store.create_slug('A title', 'entry', '') == 'Atitle'
+
+def test_entry_fragment():
+    assert make_fragment(
+        '<?xml version="1.0"?>\n<entry xmlns="%s" xmlns:x="urn:x">'
+        '<id>a</id></entry>\n' % atom.atom_ns) == (
+        '<entry xmlns:x="urn:x"><id>a</id></entry>')
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    fragment = store.entry_fragment(slug)
+    assert fragment.startswith('<entry')
+    assert 'xmlns="%s"' % atom.atom_ns not in fragment
+    feed = atom.ATOM('<feed xmlns="%s">%s</feed>' % (atom.atom_ns, fragment))
+    assert [entry.id for entry in feed.entries] == ['test1']
+    assert store.entry_fragment(slug) is fragment
+    entry = store.get_entry(slug)
+    entry.atom_entry.title = 'Changed'
+    entry.save()
+    assert 'Changed' in store.entry_fragment(slug)
+
+def test_simple_index_listing():
+    index = naiveindex.SimpleIndex()
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    store = Store(output_dir, index=index)
+    listings = []
+    def entry_slugs(store=store, entry_slugs=store.entry_slugs):
+        listings.append(1)
+        return entry_slugs()
+    store.entry_slugs = entry_slugs
+    slugs = [add_entry(store, 'test%s' % i) for i in range(3)]
+    assert index.most_recent(store, 0, 2) == (3, [slugs[2], slugs[1]])
+    assert len(listings) == 1
+    entry = store.get_entry(slugs[0])
+    entry.atom_entry.title = 'Updated'
+    entry.save()
+    store.get_entry(slugs[1]).delete()
+    assert index.most_recent(store, 0, None)[1] == [slugs[0], slugs[2]]
+    # Kept up to date without listing the store again:
+    assert len(listings) == 1
+    # But another process's changes are noticed:
+    store2 = Store(output_dir, index=naiveindex.Index())
+    slug = add_entry(store2, 'test3')
+    assert index.most_recent(store, 0, 1)[1] == [slug]
+    assert len(listings) == 2
+    page = [slug, slugs[0], slugs[2]]
+    assert index.most_recent(store, 1, 5) == (3, page[1:])
+    assert index.most_recent_page(store, 2) == [(s, s) for s in page[:2]]
+    assert index.most_recent_page(store, 1, after=slug) == [
+        (slugs[0], slugs[0])]
+    assert index.most_recent_page(store, None, before=slugs[2]) == [
+        (s, s) for s in page[:2]]
+    assert index.most_recent_page(store, 1, before=slugs[2]) == [
+        (slugs[0], slugs[0])]
+    try:
+        index.most_recent_page(store, 1, after=slugs[1])
+    except ValueError:
+        pass
+    else:
+        assert 0, "ValueError expected"
+    store.clear()
+    assert index.most_recent(store, 0, None) == (0, [])
+
+def test_sidecar_slugs():
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    for bad in [slug + '.etag', '.collection', '.slug-counter',
+                'image.jpg.content-type']:
+        try:
+            store.get_filename(bad, 'entry')
+        except ValueError:
+            pass
+        else:
+            assert 0, "%r should be rejected" % bad
+    # Reading the ETag of a reserved (empty) entry doesn't store it:
+    reserved = store.create_slug('reserved', 'entry', '')
+    store.etag(reserved, 'entry')
+    assert not os.path.exists(store.get_filename(reserved, 'entry', '.etag'))
+
+def test_etag_while_saving():
+    store = make_store()
+    slug = add_entry(store, 'test1')
+    old_fp, old_info = store.open_entry(slug)
+    old_body = old_fp.read()
+    old_inode = os.fstat(old_fp.fileno()).st_ino
+    entry = store.get_entry(slug)
+    entry.atom_entry.title = 'Updated'
+    entry.save()
+    # A request that opened the old body keeps the old body's ETag,
+    # though the new ETag is stored by now:
+    assert store.entry_etag(slug, old_fp) == md5.new(old_body).hexdigest()
+    old_fp.close()
+    new_fp, new_info = store.open_entry(slug)
+    assert new_info.etag == md5.new(new_fp.read()).hexdigest()
+    assert new_info.etag != old_info.etag
+    new_fp.close()
+    # The new body with the old .etag file (as if another request
+    # wrote it between the two writes) still gets the new ETag:
+    f = open(store.get_filename(slug, 'entry', '.etag'), 'wb')
+    f.write('%s %s' % (old_info.etag, old_inode))
+    f.close()
+    assert store.etag(slug, 'entry') == new_info.etag